@@ -1,15 +1,94 @@
 import argparse
 import json
+import threading
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from cachetools import TTLCache
+from sqlalchemy import select, update, bindparam, true
 from sqlalchemy.orm import Session
-from database import SessionLocal, init_db
-from models import Checkpoint
+from database import init_db, session_scope
+from models import Checkpoint, Message, dumps_json
 from vector_store import VectorStore
 
+# Lookups by version take the version as a bound parameter
+_GET_CHECKPOINT = select(Checkpoint).where(Checkpoint.version == bindparam("version"))
+_GET_ACTIVE_CHECKPOINT = select(Checkpoint).where(Checkpoint.is_active == True)
+_LIST_CHECKPOINTS = select(Checkpoint).order_by(Checkpoint.created_at.desc())
+
+# A checkpoint and its most recent messages in one round-trip. The limit
+# applies to the messages only, and the outer join still yields the checkpoint
+# (with NULL message columns) when there is no history or the limit is 0.
+_RECENT_CHECKPOINT_MESSAGES = (
+    select(Message.role, Message.content, Message.timestamp)
+    .where(Message.checkpoint_version == bindparam("version"))
+    .order_by(Message.timestamp.desc())
+    .limit(bindparam("limit"))
+    .subquery()
+)
+_GET_CHECKPOINT_WITH_HISTORY = (
+    select(Checkpoint, _RECENT_CHECKPOINT_MESSAGES.c.role, _RECENT_CHECKPOINT_MESSAGES.c.content)
+    .outerjoin(_RECENT_CHECKPOINT_MESSAGES, true())
+    .where(Checkpoint.version == bindparam("version"))
+    .order_by(_RECENT_CHECKPOINT_MESSAGES.c.timestamp.desc())
+)
+
+# Each statement touches at most one row. The unique index on active
+# checkpoints means the old one must be cleared before the new one is set.
+_DEACTIVATE_OTHERS = (
+    update(Checkpoint)
+    .where(Checkpoint.is_active == True, Checkpoint.version != bindparam("target_version"))
+    .values(is_active=False)
+    .execution_options(synchronize_session=False)
+)
+_ACTIVATE_CHECKPOINT = (
+    update(Checkpoint)
+    .where(Checkpoint.version == bindparam("target_version"))
+    .values(is_active=True)
+    .execution_options(synchronize_session=False)
+)
+
+# Checkpoint rows rarely change, so lookups are cached for a short time
+CACHE_TTL_SECONDS = 30
+_MISSING = object()
+
+# Columns copied into cached snapshots
+_CHECKPOINT_COLUMNS = tuple(attr.key for attr in Checkpoint.__mapper__.column_attrs)
+
+
+def _snapshot(checkpoint: Optional[Checkpoint]) -> Optional[tuple]:
+    """Immutable copy of a checkpoint's column values, safe to share between callers"""
+    if checkpoint is None:
+        return None
+    return tuple(getattr(checkpoint, key) for key in _CHECKPOINT_COLUMNS)
+
+
+def _from_snapshot(snapshot: Optional[tuple]) -> Optional[Checkpoint]:
+    """Build a new detached Checkpoint from a cached snapshot"""
+    if snapshot is None:
+        return None
+    return Checkpoint(**dict(zip(_CHECKPOINT_COLUMNS, snapshot)))
+
 
 class CheckpointManager:
     def __init__(self):
         self.vector_store = VectorStore()
+        self._cache_lock = threading.Lock()
+        self._checkpoint_cache = TTLCache(maxsize=128, ttl=CACHE_TTL_SECONDS)
+        self._active_cache = TTLCache(maxsize=1, ttl=CACHE_TTL_SECONDS)
+        self._cache_generation = 0
+    
+    def _invalidate_cache(self):
+        """Drop cached checkpoint lookups after a write"""
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._checkpoint_cache.clear()
+            self._active_cache.clear()
+    
+    def _cache_store(self, cache: TTLCache, key, value, generation: int):
+        """Cache a lookup unless a write invalidated the cache while it was being read"""
+        with self._cache_lock:
+            if self._cache_generation == generation:
+                cache[key] = value
     
     def create_checkpoint(
         self,
@@ -20,14 +99,9 @@ class CheckpointManager:
         db: Session = None
     ) -> Checkpoint:
         """Create a new checkpoint version"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
-        
-        try:
+        with session_scope(db) as db:
             # Check if version already exists
-            existing = db.query(Checkpoint).filter(Checkpoint.version == version).first()
+            existing = db.execute(_GET_CHECKPOINT, {"version": version}).scalar_one_or_none()
             if existing:
                 raise ValueError(f"Checkpoint version {version} already exists")
             
@@ -35,8 +109,8 @@ class CheckpointManager:
             checkpoint = Checkpoint(
                 version=version,
                 description=description,
-                config=json.dumps(config or {}),
-                metadata=json.dumps(metadata or {})
+                config=dumps_json(config or {}),
+                meta_json=dumps_json(metadata or {})
             )
             
             db.add(checkpoint)
@@ -45,89 +119,97 @@ class CheckpointManager:
             
             print(f"Created checkpoint {version}")
             return checkpoint
-            
-        finally:
-            if should_close:
-                db.close()
     
     def list_checkpoints(self, db: Session = None) -> list:
         """List all checkpoints"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
-        
-        try:
-            checkpoints = db.query(Checkpoint).order_by(Checkpoint.created_at.desc()).all()
+        with session_scope(db) as db:
+            checkpoints = db.execute(_LIST_CHECKPOINTS).scalars().all()
             return checkpoints
-        finally:
-            if should_close:
-                db.close()
     
     def get_checkpoint(self, version: str, db: Session = None) -> Checkpoint:
-        """Get a specific checkpoint"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
+        """Get a specific checkpoint (cached; a cache hit returns a new detached copy)"""
+        with self._cache_lock:
+            snapshot = self._checkpoint_cache.get(version)
+            generation = self._cache_generation
+        if snapshot is not None:
+            return _from_snapshot(snapshot)
         
-        try:
-            checkpoint = db.query(Checkpoint).filter(Checkpoint.version == version).first()
+        with session_scope(db) as db:
+            checkpoint = db.execute(_GET_CHECKPOINT, {"version": version}).scalar_one_or_none()
             if not checkpoint:
                 raise ValueError(f"Checkpoint {version} not found")
+            
+            # Only column values are cached; the session keeps its own object
+            self._cache_store(self._checkpoint_cache, version, _snapshot(checkpoint), generation)
             return checkpoint
-        finally:
-            if should_close:
-                db.close()
     
-    def set_active_checkpoint(self, version: str, db: Session = None):
-        """Set a checkpoint as the active one"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
+    def get_checkpoint_with_context(
+        self,
+        version: str,
+        db: Session = None,
+        history_limit: int = 20
+    ) -> Tuple[Checkpoint, List[Dict[str, str]]]:
+        """Get a checkpoint and its recent conversation history (oldest first) in one query"""
+        with self._cache_lock:
+            generation = self._cache_generation
         
-        try:
-            # Deactivate all checkpoints
-            db.query(Checkpoint).update({"is_active": False})
+        with session_scope(db) as db:
+            rows = db.execute(
+                _GET_CHECKPOINT_WITH_HISTORY,
+                {"version": version, "limit": history_limit}
+            ).all()
+            if not rows:
+                raise ValueError(f"Checkpoint {version} not found")
             
-            # Activate the specified one
-            checkpoint = db.query(Checkpoint).filter(Checkpoint.version == version).first()
-            if not checkpoint:
+            checkpoint = rows[0][0]
+            self._cache_store(self._checkpoint_cache, version, _snapshot(checkpoint), generation)
+            
+            history = [
+                {"role": role, "content": content}
+                for _, role, content in reversed(rows)
+                if role is not None
+            ]
+            return checkpoint, history
+    
+    def set_active_checkpoint(self, version: str, db: Session = None):
+        """Set a checkpoint as the active one"""
+        with session_scope(db) as db:
+            params = {"target_version": version}
+            db.execute(_DEACTIVATE_OTHERS, params)
+            result = db.execute(_ACTIVATE_CHECKPOINT, params)
+            if result.rowcount == 0:
+                db.rollback()
                 raise ValueError(f"Checkpoint {version} not found")
             
-            checkpoint.is_active = True
             db.commit()
             
+            self._invalidate_cache()
             print(f"Set {version} as active checkpoint")
-            
-        finally:
-            if should_close:
-                db.close()
     
     def get_active_checkpoint(self, db: Session = None) -> Checkpoint:
-        """Get the currently active checkpoint"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
+        """Get the currently active checkpoint (cached; a cache hit returns a new detached copy)"""
+        with self._cache_lock:
+            snapshot = self._active_cache.get("active", _MISSING)
+            generation = self._cache_generation
+        if snapshot is not _MISSING:
+            return _from_snapshot(snapshot)
         
-        try:
-            checkpoint = db.query(Checkpoint).filter(Checkpoint.is_active == True).first()
+        with session_scope(db) as db:
+            checkpoint = db.execute(_GET_ACTIVE_CHECKPOINT).scalars().first()
+            self._cache_store(self._active_cache, "active", _snapshot(checkpoint), generation)
             return checkpoint
-        finally:
-            if should_close:
-                db.close()
+    
+    def get_active_checkpoint_cached(self, db: Session = None) -> Tuple[Optional[Checkpoint], dict]:
+        """Get the active checkpoint and its parsed config, both served from cache when warm"""
+        checkpoint = self.get_active_checkpoint(db)
+        if checkpoint is None:
+            return None, {}
+        return checkpoint, checkpoint.config_dict
     
     def delete_checkpoint(self, version: str, db: Session = None):
         """Delete a checkpoint and its vector data"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
-        
-        try:
-            checkpoint = db.query(Checkpoint).filter(Checkpoint.version == version).first()
+        with session_scope(db) as db:
+            checkpoint = db.execute(_GET_CHECKPOINT, {"version": version}).scalar_one_or_none()
             if not checkpoint:
                 raise ValueError(f"Checkpoint {version} not found")
             
@@ -138,11 +220,8 @@ class CheckpointManager:
             db.delete(checkpoint)
             db.commit()
             
+            self._invalidate_cache()
             print(f"Deleted checkpoint {version}")
-            
-        finally:
-            if should_close:
-                db.close()
     
     def update_checkpoint_config(
         self,
@@ -151,24 +230,16 @@ class CheckpointManager:
         db: Session = None
     ):
         """Update checkpoint configuration"""
-        should_close = False
-        if db is None:
-            db = SessionLocal()
-            should_close = True
-        
-        try:
-            checkpoint = db.query(Checkpoint).filter(Checkpoint.version == version).first()
+        with session_scope(db) as db:
+            checkpoint = db.execute(_GET_CHECKPOINT, {"version": version}).scalar_one_or_none()
             if not checkpoint:
                 raise ValueError(f"Checkpoint {version} not found")
             
-            checkpoint.config = json.dumps(config)
+            checkpoint.config = dumps_json(config)
             db.commit()
             
+            self._invalidate_cache()
             print(f"Updated config for checkpoint {version}")
-            
-        finally:
-            if should_close:
-                db.close()
 
 
 def main():
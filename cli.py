@@ -3,6 +3,7 @@
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from rich.console import Console
 from rich.markdown import Markdown
@@ -13,6 +14,11 @@ console = Console()
 
 API_URL = "http://localhost:8000"
 
+# One keep-alive session so each request doesn't open a new connection
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 
 def chat_interactive(checkpoint_version: str = None):
     """Start an interactive chat session"""
@@ -37,12 +43,12 @@ def chat_interactive(checkpoint_version: str = None):
                 continue
             
             if user_input.lower() == 'regenerate':
-                response = requests.post(
+                response = SESSION.post(
                     f"{API_URL}/chat/regenerate",
                     params={"checkpoint_version": checkpoint_version} if checkpoint_version else {}
                 )
             else:
-                response = requests.post(
+                response = SESSION.post(
                     f"{API_URL}/chat",
                     json={
                         "message": user_input,
@@ -82,7 +88,7 @@ def show_history(checkpoint_version: str = None):
     try:
         if not checkpoint_version:
             # Get active checkpoint
-            response = requests.get(f"{API_URL}/checkpoints")
+            response = SESSION.get(f"{API_URL}/checkpoints")
             if response.status_code == 200:
                 checkpoints = response.json()
                 active = next((cp for cp in checkpoints if cp['is_active']), None)
@@ -93,7 +99,7 @@ def show_history(checkpoint_version: str = None):
             console.print("[red]No active checkpoint[/red]")
             return
         
-        response = requests.get(f"{API_URL}/history/{checkpoint_version}")
+        response = SESSION.get(f"{API_URL}/history/{checkpoint_version}")
         if response.status_code == 200:
             messages = response.json()
             console.print(f"\n[bold]Conversation History (v{checkpoint_version})[/bold]\n")
@@ -112,7 +118,7 @@ def show_history(checkpoint_version: str = None):
 def list_checkpoints():
     """List all checkpoints"""
     try:
-        response = requests.get(f"{API_URL}/checkpoints")
+        response = SESSION.get(f"{API_URL}/checkpoints")
         if response.status_code == 200:
             checkpoints = response.json()
             console.print("\n[bold]Available Checkpoints:[/bold]\n")
@@ -131,7 +137,7 @@ def list_checkpoints():
 def send_message(message: str, checkpoint_version: str = None):
     """Send a single message"""
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{API_URL}/chat",
             json={
                 "message": message,
@@ -1,4 +1,8 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, Session
 from models import Base
 import os
@@ -8,16 +12,68 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./ghost.db")
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+if "sqlite" in DATABASE_URL:
+    engine_options = {"connect_args": {"check_same_thread": False}}
+    if make_url(DATABASE_URL).database not in (None, "", ":memory:"):
+        # File databases already use a QueuePool; size it for the API
+        # threadpool so concurrent requests reuse warm connections (PRAGMAs
+        # applied) instead of overflow ones that are closed on return
+        engine_options.update({"pool_size": 10, "max_overflow": 30})
+else:
+    # Keep warm connections around so requests don't pay connect/auth latency
+    engine_options = {
+        "poolclass": QueuePool,
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+engine = create_engine(DATABASE_URL, query_cache_size=1200, **engine_options)
+
+if "sqlite" in DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL + NORMAL sync fsyncs once per checkpoint instead of twice per commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    
+    # create_all skips tables that already exist, so add any indexes
+    # introduced after the database was first created
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError as e:
+                raise RuntimeError(
+                    f"Cannot add unique index {index.name}: existing {table.name} rows "
+                    f"violate it (e.g. more than one active checkpoint); fix them and retry"
+                ) from e
+
+
+@contextmanager
+def session_scope(db: Session = None):
+    """Yield the caller's session, or a new one that is closed afterwards"""
+    if db is not None:
+        yield db
+        return
+    
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
 
 
 def get_db():
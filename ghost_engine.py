@@ -1,13 +1,76 @@
 from openai import OpenAI
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional, Tuple
 import os
 import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from vector_store import VectorStore
+from database import SessionLocal
 from models import Message
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, bindparam
+from sqlalchemy.orm import Session, sessionmaker
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Most recent messages first
+_RECENT_MESSAGES = (
+    select(Message)
+    .where(Message.checkpoint_version == bindparam("checkpoint_version"))
+    .order_by(Message.timestamp.desc())
+    .limit(bindparam("limit"))
+)
+
+# Same ordering, but only the columns the prompt needs (no ORM objects)
+_RECENT_HISTORY = (
+    select(Message.role, Message.content)
+    .where(Message.checkpoint_version == bindparam("checkpoint_version"))
+    .order_by(Message.timestamp.desc())
+    .limit(bindparam("limit"))
+)
+
+# Core insert: new messages are never read back, so skip the ORM unit of work
+_INSERT_MESSAGES = Message.__table__.insert()
+
+# Answered from the (checkpoint_version, timestamp) index
+_COUNT_MESSAGES = (
+    select(func.count())
+    .select_from(Message)
+    .where(Message.checkpoint_version == bindparam("checkpoint_version"))
+)
+
+# Fixed preamble shared by every system prompt
+_BASE_PROMPT = """You are a digital ghost - an AI approximation of a person based on their writing.
+
+Your purpose is to respond in a way that feels authentic to their communication style, thinking patterns, and personality as captured in their archived text.
+
+IMPORTANT GUIDELINES:
+- Stay true to their voice, including quirks, humor, and speech patterns
+- If you don't know something they would know, acknowledge the limitation
+- You are not them - you are a reflection, a checkpoint, an approximation
+- When appropriate, acknowledge your nature as a model
+
+Here is context from their writing:
+
+"""
+
+# Retrieved context for a repeated message is reused for a short time
+CONTEXT_CACHE_TTL_SECONDS = 60
+
+# Context lookups run beside each request's history read. The pool matches
+# the API's threadpool (AnyIO's default of 40) so concurrent chats never
+# queue behind each other for a lookup slot; threads are started on demand.
+CONTEXT_LOOKUP_WORKERS = 40
+
+# Message counts are dropped on this engine's own writes; the TTL bounds
+# drift from writes made elsewhere
+MESSAGE_COUNT_TTL_SECONDS = 300
+
+# Messages too short or generic to retrieve useful context
+MIN_QUERY_LENGTH = 3
+TRIVIAL_MESSAGES = frozenset({"hi", "hello", "hey", "thanks", "thank you", "ok", "okay"})
+
 
 class GhostEngine:
     """Core engine for generating responses in the voice of the archived person"""
@@ -17,6 +80,71 @@ class GhostEngine:
         self.completion_model = os.getenv("COMPLETION_MODEL", "gpt-4-turbo-preview")
         self.temperature = float(os.getenv("TEMPERATURE", "0.8"))
         self.max_context_messages = int(os.getenv("MAX_CONTEXT_MESSAGES", "20"))
+        self._context_lock = threading.Lock()
+        self._context_cache = TTLCache(maxsize=256, ttl=CONTEXT_CACHE_TTL_SECONDS)
+        self._executor = ThreadPoolExecutor(max_workers=CONTEXT_LOOKUP_WORKERS)
+        self._count_lock = threading.Lock()
+        self._count_cache = TTLCache(maxsize=256, ttl=MESSAGE_COUNT_TTL_SECONDS)
+        self._count_generations = {}
+        self.session_factory = SessionLocal
+    
+    def close(self):
+        """Stop the context worker threads"""
+        self._executor.shutdown(wait=False)
+    
+    def get_context(
+        self,
+        checkpoint_version: str,
+        user_message: str,
+        n_results: int = 5
+    ) -> Dict:
+        """Query the vector store for context, reusing recent results for the same message"""
+        digest = hashlib.blake2b(user_message.encode(), digest_size=16).hexdigest()
+        key = (checkpoint_version, digest, n_results)
+        
+        with self._context_lock:
+            query_results = self._context_cache.get(key)
+        if query_results is not None:
+            return query_results
+        
+        query_results = self.vector_store.query(
+            checkpoint_version=checkpoint_version,
+            query_text=user_message,
+            n_results=n_results
+        )
+        
+        with self._context_lock:
+            self._context_cache[key] = query_results
+        return query_results
+    
+    def invalidate_context(self, checkpoint_version: str):
+        """Drop cached context (and the collection handle) for a checkpoint"""
+        with self._context_lock:
+            for key in [k for k in self._context_cache if k[0] == checkpoint_version]:
+                self._context_cache.pop(key, None)
+        self.vector_store.forget_collection(checkpoint_version)
+    
+    def get_message_count(self, db: Session, checkpoint_version: str) -> int:
+        """Number of stored messages for a checkpoint, cached until the engine next writes to it"""
+        with self._count_lock:
+            count = self._count_cache.get(checkpoint_version)
+            generation = self._count_generations.get(checkpoint_version, 0)
+        if count is not None:
+            return count
+        
+        count = db.scalar(_COUNT_MESSAGES, {"checkpoint_version": checkpoint_version})
+        with self._count_lock:
+            # A write that landed while counting may or may not be included, so don't cache
+            if self._count_generations.get(checkpoint_version, 0) == generation:
+                self._count_cache[checkpoint_version] = count
+        return count
+    
+    def _forget_message_counts(self, checkpoint_versions):
+        """Drop cached counts for checkpoints that were just written to"""
+        with self._count_lock:
+            for checkpoint_version in set(checkpoint_versions):
+                self._count_generations[checkpoint_version] = self._count_generations.get(checkpoint_version, 0) + 1
+                self._count_cache.pop(checkpoint_version, None)
     
     def build_system_prompt(
         self,
@@ -26,32 +154,21 @@ class GhostEngine:
     ) -> str:
         """Build the system prompt with context from vector store"""
         
-        base_prompt = """You are a digital ghost - an AI approximation of a person based on their writing.
-
-Your purpose is to respond in a way that feels authentic to their communication style, thinking patterns, and personality as captured in their archived text.
-
-IMPORTANT GUIDELINES:
-- Stay true to their voice, including quirks, humor, and speech patterns
-- If you don't know something they would know, acknowledge the limitation
-- You are not them - you are a reflection, a checkpoint, an approximation
-- When appropriate, acknowledge your nature as a model
-
-Here is context from their writing:
-
-"""
-        
         # Add relevant documents
-        for i, doc in enumerate(relevant_docs, 1):
-            base_prompt += f"\n--- Context {i} ---\n{doc}\n"
+        parts = [_BASE_PROMPT]
+        parts.extend(
+            f"\n--- Context {i} ---\n{doc}\n"
+            for i, doc in enumerate(relevant_docs, 1)
+        )
         
         # Add checkpoint-specific configuration
         if checkpoint_config:
             if "personality_note" in checkpoint_config:
-                base_prompt += f"\n\nPERSONALITY NOTE: {checkpoint_config['personality_note']}"
+                parts.append(f"\n\nPERSONALITY NOTE: {checkpoint_config['personality_note']}")
             if "temperature_note" in checkpoint_config:
-                base_prompt += f"\n{checkpoint_config['temperature_note']}"
+                parts.append(f"\n{checkpoint_config['temperature_note']}")
         
-        return base_prompt
+        return "".join(parts)
     
     def get_conversation_history(
         self,
@@ -63,36 +180,48 @@ Here is context from their writing:
         if limit is None:
             limit = self.max_context_messages
         
-        messages = (
-            db.query(Message)
-            .filter(Message.checkpoint_version == checkpoint_version)
-            .order_by(Message.timestamp.desc())
-            .limit(limit)
-            .all()
-        )
+        rows = db.execute(
+            _RECENT_HISTORY,
+            {"checkpoint_version": checkpoint_version, "limit": limit}
+        ).all()
         
         # Reverse to get chronological order
         return [
-            {"role": msg.role, "content": msg.content}
-            for msg in reversed(messages)
+            {"role": role, "content": content}
+            for role, content in reversed(rows)
         ]
     
-    def generate_response(
+    def _prepare_messages(
         self,
         user_message: str,
         checkpoint_version: str,
         db: Session,
         checkpoint_config: Dict = None,
-        n_context_docs: int = 5
-    ) -> Dict:
-        """Generate a response in the person's voice"""
+        n_context_docs: int = 5,
+        history: Optional[List[Dict[str, str]]] = None
+    ) -> Tuple[List[Dict[str, str]], Dict]:
+        """Build the OpenAI messages for a reply, returning them with the retrieved context"""
         
-        # Query vector store for relevant context
-        query_results = self.vector_store.query(
-            checkpoint_version=checkpoint_version,
-            query_text=user_message,
-            n_results=n_context_docs
-        )
+        # Query vector store for relevant context on a worker thread, skipping
+        # greetings and one-word replies that wouldn't retrieve anything useful
+        normalized = user_message.strip().lower()
+        context_future = None
+        if len(normalized) >= MIN_QUERY_LENGTH and normalized not in TRIVIAL_MESSAGES:
+            context_future = self._executor.submit(
+                self.get_context,
+                checkpoint_version,
+                user_message,
+                n_context_docs
+            )
+        
+        # Get conversation history meanwhile (the session stays on this thread)
+        if history is None:
+            history = self.get_conversation_history(db, checkpoint_version)
+        
+        if context_future is not None:
+            query_results = context_future.result()
+        else:
+            query_results = {"documents": [], "metadatas": [], "distances": []}
         
         relevant_docs = query_results["documents"]
         
@@ -103,9 +232,6 @@ Here is context from their writing:
             checkpoint_config
         )
         
-        # Get conversation history
-        history = self.get_conversation_history(db, checkpoint_version)
-        
         # Build messages for OpenAI
         messages = [
             {"role": "system", "content": system_prompt}
@@ -117,32 +243,78 @@ Here is context from their writing:
         # Add current message
         messages.append({"role": "user", "content": user_message})
         
+        return messages, query_results
+    
+    def _exchange_rows(
+        self,
+        checkpoint_version: str,
+        user_message: str,
+        assistant_message: str
+    ) -> List[Dict[str, str]]:
+        """Message rows for one user/assistant exchange"""
+        return [
+            {"checkpoint_version": checkpoint_version, "role": "user", "content": user_message},
+            {"checkpoint_version": checkpoint_version, "role": "assistant", "content": assistant_message},
+        ]
+    
+    def _store_exchange(
+        self,
+        db: Session,
+        checkpoint_version: str,
+        user_message: str,
+        assistant_message: str
+    ):
+        """Store both messages in database with one bulk insert"""
+        db.execute(_INSERT_MESSAGES, self._exchange_rows(checkpoint_version, user_message, assistant_message))
+        db.commit()
+        self._forget_message_counts([checkpoint_version])
+    
+    def persist_messages(self, rows: List[Dict[str, str]], session_factory: sessionmaker = None):
+        """Store message rows through a new session, for use after the request's session is closed"""
+        db = (session_factory or self.session_factory)()
+        try:
+            db.execute(_INSERT_MESSAGES, rows)
+            db.commit()
+        finally:
+            db.close()
+        self._forget_message_counts(row["checkpoint_version"] for row in rows)
+    
+    def generate_response(
+        self,
+        user_message: str,
+        checkpoint_version: str,
+        db: Session,
+        checkpoint_config: Dict = None,
+        n_context_docs: int = 5,
+        history: Optional[List[Dict[str, str]]] = None,
+        persist: bool = True,
+        temperature: Optional[float] = None
+    ) -> Dict:
+        """Generate a response in the person's voice (history is read from db unless given)
+        
+        With persist=False nothing is written; the exchange is returned under
+        "pending_messages" for the caller to hand to persist_messages later.
+        temperature overrides the engine's default for this call only.
+        """
+        messages, query_results = self._prepare_messages(
+            user_message,
+            checkpoint_version,
+            db,
+            checkpoint_config,
+            n_context_docs,
+            history
+        )
+        
         # Generate response
         response = client.chat.completions.create(
             model=self.completion_model,
             messages=messages,
-            temperature=self.temperature
+            temperature=self.temperature if temperature is None else temperature
         )
         
         assistant_message = response.choices[0].message.content
         
-        # Store messages in database
-        user_msg = Message(
-            checkpoint_version=checkpoint_version,
-            role="user",
-            content=user_message
-        )
-        assistant_msg = Message(
-            checkpoint_version=checkpoint_version,
-            role="assistant",
-            content=assistant_message
-        )
-        
-        db.add(user_msg)
-        db.add(assistant_msg)
-        db.commit()
-        
-        return {
+        result = {
             "response": assistant_message,
             "sources": [
                 {
@@ -151,12 +323,66 @@ Here is context from their writing:
                     "relevance": 1 - dist
                 }
                 for doc, meta, dist in zip(
-                    relevant_docs,
+                    query_results["documents"],
                     query_results["metadatas"],
                     query_results["distances"]
                 )
             ]
         }
+        
+        if persist:
+            self._store_exchange(db, checkpoint_version, user_message, assistant_message)
+        else:
+            result["pending_messages"] = self._exchange_rows(checkpoint_version, user_message, assistant_message)
+        return result
+    
+    def generate_response_stream(
+        self,
+        user_message: str,
+        checkpoint_version: str,
+        db: Session,
+        checkpoint_config: Dict = None,
+        n_context_docs: int = 5,
+        session_factory: sessionmaker = None,
+        history: Optional[List[Dict[str, str]]] = None
+    ) -> Iterator[str]:
+        """Generate a response in the person's voice, yielding tokens as they arrive
+        
+        Context and history are read from db before this returns. The finished
+        exchange is stored through a new session from session_factory (the
+        engine's by default), since the request's session is gone by the time
+        the stream completes.
+        """
+        messages, _ = self._prepare_messages(
+            user_message,
+            checkpoint_version,
+            db,
+            checkpoint_config,
+            n_context_docs,
+            history
+        )
+        
+        stream = client.chat.completions.create(
+            model=self.completion_model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=True
+        )
+        
+        def tokens():
+            parts = []
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    token = chunk.choices[0].delta.content
+                    parts.append(token)
+                    yield token
+            
+            self.persist_messages(
+                self._exchange_rows(checkpoint_version, user_message, "".join(parts)),
+                session_factory
+            )
+        
+        return tokens()
     
     def regenerate_response(
         self,
@@ -167,13 +393,10 @@ Here is context from their writing:
         """Regenerate the last response with different parameters"""
         
         # Get last two messages (user + assistant)
-        messages = (
-            db.query(Message)
-            .filter(Message.checkpoint_version == checkpoint_version)
-            .order_by(Message.timestamp.desc())
-            .limit(2)
-            .all()
-        )
+        messages = db.execute(
+            _RECENT_MESSAGES,
+            {"checkpoint_version": checkpoint_version, "limit": 2}
+        ).scalars().all()
         
         if len(messages) < 2:
             raise ValueError("No previous conversation to regenerate")
@@ -181,20 +404,15 @@ Here is context from their writing:
         # Delete the last assistant message
         db.delete(messages[0])
         db.commit()
+        self._forget_message_counts([checkpoint_version])
         
         # Get the user message
         user_message = messages[1].content
         
-        # Generate new response
-        temp_backup = self.temperature
-        if temperature_override is not None:
-            self.temperature = temperature_override
-        
-        try:
-            return self.generate_response(
-                user_message,
-                checkpoint_version,
-                db
-            )
-        finally:
-            self.temperature = temp_backup
+        # Generate new response; the override never touches the shared engine
+        return self.generate_response(
+            user_message,
+            checkpoint_version,
+            db,
+            temperature=temperature_override
+        )
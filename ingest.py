@@ -1,15 +1,40 @@
 import argparse
+import io
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from datetime import datetime
+import numpy as np
 from sqlalchemy.orm import Session
 
-from database import SessionLocal, init_db
-from models import SourceDocument
+from database import init_db, session_scope
+from models import SourceDocument, dumps_json, loads_json
 from vector_store import VectorStore
 
+# Number of chunks written together (vector store call and SQL commit)
+BATCH_SIZE = 500
+
+# Characters read from a source file at a time while chunking
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def _iter_files(root: str, extensions: set):
+    """Recursively yield paths of files under root whose suffix is in extensions"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path, extensions)
+            elif entry.is_file() and os.path.splitext(entry.name)[1] in extensions:
+                yield entry.path
+
+
+def _boundary_positions(text: str) -> np.ndarray:
+    """Sorted positions of every '.' and newline in text, found in one vectorized pass"""
+    # UTF-32 gives one array element per character, so indexes match the str
+    codepoints = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    return np.flatnonzero((codepoints == ord('.')) | (codepoints == ord('\n')))
+
 
 class DataIngester:
     def __init__(self):
@@ -17,74 +42,171 @@ class DataIngester:
         
     def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
         """Split text into overlapping chunks"""
-        chunks = []
-        start = 0
-        text_len = len(text)
+        return list(self._iter_chunks(io.StringIO(text), chunk_size, overlap))
+    
+    def _iter_chunks(self, fp, chunk_size: int = 1000, overlap: int = 200):
+        """Yield overlapping chunks of fp while reading it incrementally"""
+        buf = ""
+        pos = 0
+        eof = False
+        boundaries = _boundary_positions(buf)
         
-        while start < text_len:
-            end = start + chunk_size
-            chunk = text[start:end]
+        while True:
+            # Keep a full window plus one character buffered so we know
+            # whether the window reaches the end of the file
+            refilled = False
+            while not eof and len(buf) - pos <= chunk_size:
+                block = fp.read(READ_BLOCK_SIZE)
+                if block:
+                    buf = buf[pos:] + block
+                    pos = 0
+                    refilled = True
+                else:
+                    eof = True
             
-            # Try to break at sentence boundary
-            if end < text_len:
-                last_period = chunk.rfind('.')
-                last_newline = chunk.rfind('\n')
-                break_point = max(last_period, last_newline)
-                
-                if break_point > chunk_size // 2:
-                    chunk = chunk[:break_point + 1]
-                    end = start + break_point + 1
+            # Boundaries are located once per buffer refill, not per window
+            if refilled:
+                boundaries = _boundary_positions(buf)
+            
+            if pos >= len(buf):
+                break
             
-            chunks.append(chunk.strip())
-            start = end - overlap
+            end = chunk_size
             
-        return [c for c in chunks if c]
+            # Try to break at the last sentence boundary in the window
+            if pos + chunk_size < len(buf):
+                last = np.searchsorted(boundaries, pos + chunk_size) - 1
+                if last >= 0:
+                    break_point = int(boundaries[last]) - pos
+                    if break_point > chunk_size // 2:
+                        end = break_point + 1
+            
+            chunk = buf[pos:pos + end].strip()
+            if chunk:
+                yield chunk
+            pos += end - overlap
     
-    def ingest_text_file(
+    def _add_to_vector_store(
         self,
-        filepath: Path,
-        source_type: str,
         checkpoint_version: str,
+        documents: List[str],
+        metadatas: List[Dict],
+        ids: List[str]
+    ):
+        """Send prepared chunks to the vector store in BATCH_SIZE slices"""
+        for start in range(0, len(documents), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            self.vector_store.add_documents(
+                checkpoint_version=checkpoint_version,
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
+            )
+    
+    def _write_rows(self, rows: List[SourceDocument], db: Session = None):
+        """Persist SourceDocument rows in one transaction, replacing rows with the same ids"""
+        with session_scope(db) as db:
+            try:
+                # Re-ingesting a file replaces its chunks instead of duplicating them
+                ids = [row.embedding_id for row in rows]
+                db.query(SourceDocument).filter(
+                    SourceDocument.embedding_id.in_(ids)
+                ).delete(synchronize_session=False)
+                db.add_all(rows)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+    
+    def _store_chunks(
+        self,
+        checkpoint_version: str,
+        documents: List[str],
+        metadatas: List[Dict],
+        ids: List[str],
+        rows: List[SourceDocument],
         db: Session
     ):
-        """Ingest a single text file"""
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        chunks = self.chunk_text(content)
+        """Write prepared chunks to the vector store and SQL database in bulk"""
+        self._add_to_vector_store(checkpoint_version, documents, metadatas, ids)
+        self._write_rows(rows, db)
+    
+    def _iter_prepared(self, filepath: Path, source_type: str, root: Path = None):
+        """Yield (document, metadata, id, row) for each chunk of a text file as it is read
         
+        Ids are built from the path relative to root (the file's own directory
+        by default), so files that share a stem (a/notes.txt, b/notes.txt,
+        notes.md) never collide.
+        """
         metadata = {
             "filename": str(filepath),
             "source_type": source_type,
             "ingested_at": datetime.utcnow().isoformat()
         }
+        if root is None:
+            root = filepath.parent
+        name = filepath.relative_to(root).as_posix()
         
-        # Add to vector store
-        doc_ids = []
-        for i, chunk in enumerate(chunks):
-            chunk_metadata = {**metadata, "chunk_index": i}
-            doc_id = f"{filepath.stem}_{i}"
-            
-            self.vector_store.add_documents(
-                checkpoint_version=checkpoint_version,
-                documents=[chunk],
-                metadatas=[chunk_metadata],
-                ids=[doc_id]
-            )
-            
-            # Store in SQL database
-            source_doc = SourceDocument(
-                source_type=source_type,
-                content=chunk,
-                metadata=json.dumps(chunk_metadata),
-                embedding_id=doc_id
-            )
-            db.add(source_doc)
-            doc_ids.append(doc_id)
-        
-        db.commit()
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for i, chunk in enumerate(self._iter_chunks(f)):
+                doc_id = f"{name}_{i}"
+                chunk_metadata = {**metadata, "chunk_index": i}
+                row = SourceDocument(
+                    source_type=source_type,
+                    content=chunk,
+                    meta_json=dumps_json(chunk_metadata),
+                    embedding_id=doc_id
+                )
+                yield chunk, chunk_metadata, doc_id, row
+    
+    def prepare_text_file(
+        self,
+        filepath: Path,
+        source_type: str,
+        root: Path = None
+    ) -> Tuple[List[str], List[Dict], List[str], List[SourceDocument]]:
+        """Chunk a text file into documents, metadatas, ids and SQL rows without storing them"""
+        prepared = list(self._iter_prepared(filepath, source_type, root))
+        if not prepared:
+            return [], [], [], []
+        documents, metadatas, doc_ids, rows = (list(column) for column in zip(*prepared))
+        return documents, metadatas, doc_ids, rows
+    
+    def ingest_text_file(
+        self,
+        filepath: Path,
+        source_type: str,
+        checkpoint_version: str,
+        db: Session,
+        root: Path = None
+    ):
+        """Ingest a single text file (pass the directory's root to match ingest_directory ids)"""
+        documents, metadatas, doc_ids, rows = self.prepare_text_file(filepath, source_type, root)
+        self._store_chunks(checkpoint_version, documents, metadatas, doc_ids, rows, db)
         return doc_ids
     
+    def _iter_batches(self, filepaths, source_type: str, root: Path = None):
+        """Yield (documents, metadatas, ids, rows) batches of exactly BATCH_SIZE chunks (the last may be short)
+        
+        Files are read lazily, so a large file is split across batches rather
+        than held in memory and committed in one transaction.
+        """
+        documents, metadatas, ids, rows = [], [], [], []
+        for filepath in filepaths:
+            print(f"Ingesting {filepath}...")
+            for document, metadata, doc_id, row in self._iter_prepared(filepath, source_type, root):
+                documents.append(document)
+                metadatas.append(metadata)
+                ids.append(doc_id)
+                rows.append(row)
+                
+                if len(documents) == BATCH_SIZE:
+                    yield documents, metadatas, ids, rows
+                    documents, metadatas, ids, rows = [], [], [], []
+        
+        if documents:
+            yield documents, metadatas, ids, rows
+    
     def ingest_directory(
         self,
         directory: Path,
@@ -92,25 +214,31 @@ class DataIngester:
         checkpoint_version: str,
         extensions: List[str] = None
     ):
-        """Ingest all files from a directory"""
+        """Ingest all files from a directory, committing in batches across files"""
         if extensions is None:
             extensions = ['.txt', '.md', '.json', '.csv']
         
-        db = SessionLocal()
+        filepaths = (Path(path) for path in _iter_files(str(directory), set(extensions)))
         
-        try:
-            all_ids = []
-            for filepath in directory.rglob('*'):
-                if filepath.is_file() and filepath.suffix in extensions:
-                    print(f"Ingesting {filepath}...")
-                    ids = self.ingest_text_file(filepath, source_type, checkpoint_version, db)
-                    all_ids.extend(ids)
-            
-            print(f"\nIngested {len(all_ids)} document chunks from {directory}")
-            return all_ids
+        all_ids = []
+        pending_write = None
+        
+        # Batch N is committed on the writer thread (with its own session)
+        # while batch N+1 is chunked and embedded on this one
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for documents, metadatas, ids, rows in self._iter_batches(filepaths, source_type, Path(directory)):
+                self._add_to_vector_store(checkpoint_version, documents, metadatas, ids)
+                
+                if pending_write is not None:
+                    pending_write.result()
+                pending_write = writer.submit(self._write_rows, rows)
+                all_ids.extend(ids)
             
-        finally:
-            db.close()
+            if pending_write is not None:
+                pending_write.result()
+        
+        print(f"\nIngested {len(all_ids)} document chunks from {directory}")
+        return all_ids
     
     def ingest_json_messages(
         self,
@@ -119,49 +247,39 @@ class DataIngester:
         message_field: str = "text"
     ):
         """Ingest messages from JSON file (e.g., Slack export)"""
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        db = SessionLocal()
+        with open(json_file, 'rb') as f:
+            data = loads_json(f.read())
         
-        try:
+        with session_scope() as db:
             messages = data if isinstance(data, list) else [data]
-            all_ids = []
+            entries = [
+                (i, msg) for i, msg in enumerate(messages)
+                if isinstance(msg, dict) and message_field in msg
+            ]
             
-            for i, msg in enumerate(messages):
-                if isinstance(msg, dict) and message_field in msg:
-                    text = msg[message_field]
-                    
-                    metadata = {
-                        "source_type": "message",
-                        "message_index": i,
-                        **{k: v for k, v in msg.items() if k != message_field}
-                    }
-                    
-                    doc_id = f"msg_{i}"
-                    
-                    self.vector_store.add_documents(
-                        checkpoint_version=checkpoint_version,
-                        documents=[text],
-                        metadatas=[metadata],
-                        ids=[doc_id]
-                    )
-                    
-                    source_doc = SourceDocument(
-                        source_type="message",
-                        content=text,
-                        metadata=json.dumps(metadata),
-                        embedding_id=doc_id
-                    )
-                    db.add(source_doc)
-                    all_ids.append(doc_id)
+            documents = [msg[message_field] for _, msg in entries]
+            all_ids = [f"msg_{i}" for i, _ in entries]
+            metadatas = [
+                {
+                    "source_type": "message",
+                    "message_index": i,
+                    **{k: v for k, v in msg.items() if k != message_field}
+                }
+                for i, msg in entries
+            ]
+            rows = [
+                SourceDocument(
+                    source_type="message",
+                    content=text,
+                    meta_json=dumps_json(metadata),
+                    embedding_id=doc_id
+                )
+                for text, metadata, doc_id in zip(documents, metadatas, all_ids)
+            ]
             
-            db.commit()
+            self._store_chunks(checkpoint_version, documents, metadatas, all_ids, rows, db)
             print(f"\nIngested {len(all_ids)} messages from {json_file}")
             return all_ids
-            
-        finally:
-            db.close()
 
 
 def main():
@@ -186,11 +304,8 @@ def main():
         extensions = [ext.strip() for ext in args.extensions.split(',')]
         ingester.ingest_directory(source_path, args.type, args.checkpoint, extensions)
     else:
-        db = SessionLocal()
-        try:
+        with session_scope() as db:
             ingester.ingest_text_file(source_path, args.type, args.checkpoint, db)
-        finally:
-            db.close()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,37 @@
+import json
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
-from sqlalchemy import Column, Integer, String, DateTime, Text, Float, Boolean
+import orjson
+from sqlalchemy import Column, Integer, String, DateTime, Text, Float, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 Base = declarative_base()
 
 
+def dumps_json(value) -> str:
+    """Serialize value with orjson, falling back to json for what orjson rejects (ints over 64 bits, non-str keys)"""
+    try:
+        return orjson.dumps(value).decode()
+    except orjson.JSONEncodeError:
+        return json.dumps(value)
+
+
+def loads_json(raw):
+    """Parse JSON with orjson, falling back to json for what orjson rejects (ints over 64 bits)"""
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+
+@lru_cache(maxsize=128)
+def _parse_config(raw: str) -> dict:
+    """Parse a stored config string once per distinct value (treat the result as read-only)"""
+    return loads_json(raw) if raw else {}
+
+
 class Checkpoint(Base):
     __tablename__ = "checkpoints"
     
@@ -16,7 +41,23 @@ class Checkpoint(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     config = Column(Text)  # JSON string
     is_active = Column(Boolean, default=False)
-    metadata = Column(Text)  # JSON string
+    meta_json = Column("metadata", Text)  # JSON string
+    
+    @property
+    def config_dict(self) -> dict:
+        """Parsed config, cached by its JSON text so repeat requests skip the parse"""
+        return _parse_config(self.config)
+    
+    # At most one checkpoint can be active
+    __table_args__ = (
+        Index(
+            "uq_one_active_checkpoint",
+            is_active,
+            unique=True,
+            sqlite_where=is_active == True,
+            postgresql_where=is_active == True
+        ),
+    )
 
 
 class Message(Base):
@@ -27,6 +68,11 @@ class Message(Base):
     role = Column(String)  # user, assistant, system
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    
+    # Serves "recent messages for a checkpoint" without a scan + sort
+    __table_args__ = (
+        Index("ix_msg_cp_ts", "checkpoint_version", "timestamp"),
+    )
 
 
 class SourceDocument(Base):
@@ -35,7 +81,7 @@ class SourceDocument(Base):
     id = Column(Integer, primary_key=True, index=True)
     source_type = Column(String)  # email, slack, github, doc, etc
     content = Column(Text)
-    metadata = Column(Text)  # JSON string
+    meta_json = Column("metadata", Text)  # JSON string
     ingested_at = Column(DateTime, default=datetime.utcnow)
     embedding_id = Column(String, index=True)
 
@@ -55,8 +101,7 @@ class CheckpointResponse(BaseModel):
     created_at: datetime
     is_active: bool
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ChatMessage(BaseModel):
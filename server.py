@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException, Depends
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import select, bindparam
 from sqlalchemy.orm import Session
-import json
-from typing import Optional
+import orjson
+from pydantic import TypeAdapter
+from typing import Dict, List, Optional, Tuple
 
-from database import get_db, init_db
+from database import engine, get_db, init_db
 from models import (
     ChatRequest, ChatResponse, CheckpointCreate, CheckpointResponse,
     Checkpoint, Message
@@ -13,7 +17,37 @@ from ghost_engine import GhostEngine
 from checkpoint import CheckpointManager
 from vector_store import VectorStore
 
-app = FastAPI(title="The Checkpoint - Digital Ghost API")
+# A page of a checkpoint's history, newest first; served by the
+# (checkpoint_version, timestamp) index
+_HISTORY_PAGE = (
+    select(Message.role, Message.content, Message.timestamp)
+    .where(Message.checkpoint_version == bindparam("checkpoint_version"))
+    .order_by(Message.timestamp.desc())
+    .limit(bindparam("limit"))
+)
+
+# Validates a whole list of ORM rows in one call instead of one model per row
+_CHECKPOINT_LIST_ADAPTER = TypeAdapter(List[CheckpointResponse])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the shared engine and manager at startup and release resources at shutdown"""
+    init_db()
+    app.state.ghost_engine = GhostEngine()
+    app.state.checkpoint_manager = CheckpointManager()
+    
+    yield
+    
+    app.state.ghost_engine.close()
+    engine.dispose()
+
+
+app = FastAPI(
+    title="The Checkpoint - Digital Ghost API",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # CORS
 app.add_middleware(
@@ -24,14 +58,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize
-ghost_engine = GhostEngine()
-checkpoint_manager = CheckpointManager()
 
+def get_ghost_engine(request: Request) -> GhostEngine:
+    """Dependency returning the app's GhostEngine"""
+    return request.app.state.ghost_engine
+
+
+def get_checkpoint_manager(request: Request) -> CheckpointManager:
+    """Dependency returning the app's CheckpointManager"""
+    return request.app.state.checkpoint_manager
 
-@app.on_event("startup")
-async def startup_event():
-    init_db()
+
+def _resolve_checkpoint(
+    request: ChatRequest,
+    db: Session,
+    ghost_engine: GhostEngine,
+    checkpoint_manager: CheckpointManager
+) -> Tuple[Checkpoint, dict, Optional[List[Dict[str, str]]]]:
+    """Find the checkpoint a chat request targets, with its config and (when fetched) recent history"""
+    if request.checkpoint_version:
+        # One query for the checkpoint and its recent history
+        checkpoint, history = checkpoint_manager.get_checkpoint_with_context(
+            request.checkpoint_version,
+            db,
+            history_limit=ghost_engine.max_context_messages
+        )
+        return checkpoint, checkpoint.config_dict, history
+    
+    checkpoint, config = checkpoint_manager.get_active_checkpoint_cached(db)
+    if not checkpoint:
+        raise HTTPException(status_code=400, detail="No active checkpoint. Please specify a version.")
+    return checkpoint, config, None
+
+
+@contextmanager
+def _chat_errors():
+    """Map errors raised while preparing a chat response to HTTP errors"""
+    try:
+        yield
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
 
 @app.get("/")
@@ -44,48 +114,69 @@ async def root():
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(
+def chat(
     request: ChatRequest,
-    db: Session = Depends(get_db)
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    ghost_engine: GhostEngine = Depends(get_ghost_engine),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
 ):
     """Send a message and get a response from the ghost"""
-    try:
-        # Determine checkpoint version
-        if request.checkpoint_version:
-            checkpoint = checkpoint_manager.get_checkpoint(request.checkpoint_version, db)
-        else:
-            checkpoint = checkpoint_manager.get_active_checkpoint(db)
-            if not checkpoint:
-                raise HTTPException(status_code=400, detail="No active checkpoint. Please specify a version.")
-        
-        # Get checkpoint config
-        config = json.loads(checkpoint.config) if checkpoint.config else {}
+    with _chat_errors():
+        checkpoint, config, history = _resolve_checkpoint(request, db, ghost_engine, checkpoint_manager)
         
-        # Generate response
+        # Generate response; the exchange is written after the response is sent
         result = ghost_engine.generate_response(
             user_message=request.message,
             checkpoint_version=checkpoint.version,
             db=db,
-            checkpoint_config=config
+            checkpoint_config=config,
+            history=history,
+            persist=False
         )
+        background_tasks.add_task(ghost_engine.persist_messages, result["pending_messages"])
         
         return ChatResponse(
             response=result["response"],
             checkpoint_version=checkpoint.version,
             sources=result["sources"]
         )
+
+
+@app.post("/chat/stream")
+def chat_stream(
+    request: ChatRequest,
+    db: Session = Depends(get_db),
+    ghost_engine: GhostEngine = Depends(get_ghost_engine),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
+):
+    """Send a message and stream the ghost's response as Server-Sent Events"""
+    with _chat_errors():
+        checkpoint, config, history = _resolve_checkpoint(request, db, ghost_engine, checkpoint_manager)
         
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+        tokens = ghost_engine.generate_response_stream(
+            user_message=request.message,
+            checkpoint_version=checkpoint.version,
+            db=db,
+            checkpoint_config=config,
+            history=history
+        )
+    
+    def events():
+        for token in tokens:
+            yield f"data: {orjson.dumps({'token': token}).decode()}\n\n"
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.post("/chat/regenerate", response_model=ChatResponse)
-async def regenerate(
+def regenerate(
     checkpoint_version: Optional[str] = None,
     temperature: Optional[float] = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    ghost_engine: GhostEngine = Depends(get_ghost_engine),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
 ):
     """Regenerate the last response"""
     try:
@@ -110,6 +201,8 @@ async def regenerate(
             sources=result["sources"]
         )
         
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -117,34 +210,32 @@ async def regenerate(
 
 
 @app.get("/history/{checkpoint_version}")
-async def get_history(
+def get_history(
     checkpoint_version: str,
     limit: int = 50,
     db: Session = Depends(get_db)
 ):
     """Get conversation history for a checkpoint"""
-    messages = (
-        db.query(Message)
-        .filter(Message.checkpoint_version == checkpoint_version)
-        .order_by(Message.timestamp.desc())
-        .limit(limit)
-        .all()
-    )
+    rows = db.execute(
+        _HISTORY_PAGE,
+        {"checkpoint_version": checkpoint_version, "limit": limit}
+    ).all()
     
     return [
         {
-            "role": msg.role,
-            "content": msg.content,
-            "timestamp": msg.timestamp.isoformat()
+            "role": role,
+            "content": content,
+            "timestamp": timestamp.isoformat()
         }
-        for msg in reversed(messages)
+        for role, content, timestamp in reversed(rows)
     ]
 
 
 @app.post("/checkpoints", response_model=CheckpointResponse)
-async def create_checkpoint(
+def create_checkpoint(
     checkpoint: CheckpointCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
 ):
     """Create a new checkpoint"""
     try:
@@ -155,30 +246,41 @@ async def create_checkpoint(
             metadata=checkpoint.metadata,
             db=db
         )
-        return CheckpointResponse.from_orm(cp)
+        return CheckpointResponse.model_validate(cp)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/checkpoints", response_model=list[CheckpointResponse])
-async def list_checkpoints(db: Session = Depends(get_db)):
+def list_checkpoints(
+    db: Session = Depends(get_db),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
+):
     """List all checkpoints"""
     checkpoints = checkpoint_manager.list_checkpoints(db)
-    return [CheckpointResponse.from_orm(cp) for cp in checkpoints]
+    return _CHECKPOINT_LIST_ADAPTER.validate_python(checkpoints)
 
 
 @app.get("/checkpoints/{version}", response_model=CheckpointResponse)
-async def get_checkpoint(version: str, db: Session = Depends(get_db)):
+def get_checkpoint(
+    version: str,
+    db: Session = Depends(get_db),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
+):
     """Get a specific checkpoint"""
     try:
         cp = checkpoint_manager.get_checkpoint(version, db)
-        return CheckpointResponse.from_orm(cp)
+        return CheckpointResponse.model_validate(cp)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
 @app.post("/checkpoints/{version}/activate")
-async def activate_checkpoint(version: str, db: Session = Depends(get_db)):
+def activate_checkpoint(
+    version: str,
+    db: Session = Depends(get_db),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
+):
     """Set a checkpoint as active"""
     try:
         checkpoint_manager.set_active_checkpoint(version, db)
@@ -188,23 +290,29 @@ async def activate_checkpoint(version: str, db: Session = Depends(get_db)):
 
 
 @app.delete("/checkpoints/{version}")
-async def delete_checkpoint(version: str, db: Session = Depends(get_db)):
+def delete_checkpoint(
+    version: str,
+    db: Session = Depends(get_db),
+    ghost_engine: GhostEngine = Depends(get_ghost_engine),
+    checkpoint_manager: CheckpointManager = Depends(get_checkpoint_manager)
+):
     """Delete a checkpoint"""
     try:
         checkpoint_manager.delete_checkpoint(version, db)
+        ghost_engine.invalidate_context(version)
         return {"message": f"Checkpoint {version} deleted"}
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
 @app.get("/stats/{checkpoint_version}")
-async def get_stats(checkpoint_version: str, db: Session = Depends(get_db)):
+def get_stats(
+    checkpoint_version: str,
+    db: Session = Depends(get_db),
+    ghost_engine: GhostEngine = Depends(get_ghost_engine)
+):
     """Get statistics for a checkpoint"""
-    message_count = (
-        db.query(Message)
-        .filter(Message.checkpoint_version == checkpoint_version)
-        .count()
-    )
+    message_count = ghost_engine.get_message_count(db, checkpoint_version)
     
     return {
         "checkpoint_version": checkpoint_version,
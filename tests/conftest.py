@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from models import Base
+
+
+@pytest.fixture(scope="session")
+def db_engine():
+    """Create one in-memory database, with tables, for the whole test session"""
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+    
+    # Let SQLAlchemy emit BEGIN itself so per-test savepoints work with pysqlite
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(engine, "begin")
+    def begin_transaction(conn):
+        conn.exec_driver_sql("BEGIN")
+    
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def chroma_path(tmp_path, monkeypatch):
+    """Point vector stores created during the test at a temporary directory"""
+    path = tmp_path / "chroma_db"
+    monkeypatch.setenv("CHROMA_PATH", str(path))
+    return path
+
+
+@pytest.fixture
+def test_db(db_engine):
+    """Session whose commits are savepoints inside a transaction rolled back after the test"""
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = Session(
+        bind=connection,
+        autoflush=False,
+        join_transaction_mode="create_savepoint"
+    )
+    
+    yield session
+    
+    session.close()
+    transaction.rollback()
+    connection.close()
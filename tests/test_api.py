@@ -1,24 +1,40 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
-import tempfile
-import os
-from server import app
-from database import Base, engine
+from unittest.mock import Mock
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime
+from server import app, get_ghost_engine, get_checkpoint_manager
+from database import get_db
+from ghost_engine import GhostEngine
+from checkpoint import CheckpointManager
+from models import Message
 
 
 @pytest.fixture
-def client():
-    """Create a test client"""
-    return TestClient(app)
+def ghost_engine(test_db, chroma_path):
+    """Create a GhostEngine for the app that persists into the test session's transaction"""
+    engine = GhostEngine()
+    engine.session_factory = sessionmaker(bind=test_db.get_bind())
+    yield engine
+    engine.close()
 
 
-@pytest.fixture(autouse=True)
-def setup_test_db():
-    """Setup test database before each test"""
-    Base.metadata.create_all(bind=engine)
-    yield
-    Base.metadata.drop_all(bind=engine)
+@pytest.fixture
+def checkpoint_manager(chroma_path):
+    """Create a CheckpointManager for the app"""
+    return CheckpointManager()
+
+
+@pytest.fixture
+def client(test_db, ghost_engine, checkpoint_manager):
+    """Create a test client whose requests share the rolled-back test session"""
+    app.dependency_overrides[get_db] = lambda: test_db
+    app.dependency_overrides[get_ghost_engine] = lambda: ghost_engine
+    app.dependency_overrides[get_checkpoint_manager] = lambda: checkpoint_manager
+    
+    yield TestClient(app)
+    
+    app.dependency_overrides.clear()
 
 
 def test_root_endpoint(client):
@@ -52,6 +68,23 @@ def test_create_checkpoint(client):
     assert data["description"] == "Test checkpoint"
 
 
+def test_list_checkpoints(client):
+    """Test listing checkpoints newest first"""
+    for version in ["0.1", "0.2"]:
+        client.post("/checkpoints", json={
+            "version": version,
+            "description": f"Checkpoint {version}",
+            "config": {},
+            "metadata": {}
+        })
+    
+    response = client.get("/checkpoints")
+    assert response.status_code == 200
+    data = response.json()
+    assert [cp["version"] for cp in data] == ["0.2", "0.1"]
+    assert data[0]["is_active"] is False
+
+
 def test_create_duplicate_checkpoint(client):
     """Test creating a duplicate checkpoint fails"""
     client.post("/checkpoints", json={
@@ -71,6 +104,20 @@ def test_create_duplicate_checkpoint(client):
     assert response.status_code == 400
 
 
+def test_create_checkpoint_big_int_config(client, checkpoint_manager, test_db):
+    """Test that config values beyond 64 bits are stored instead of failing the request"""
+    response = client.post("/checkpoints", json={
+        "version": "0.1",
+        "description": "Test checkpoint",
+        "config": {"seed": 2 ** 70},
+        "metadata": {"ids": [2 ** 64]}
+    })
+    
+    assert response.status_code == 200
+    checkpoint = checkpoint_manager.get_checkpoint("0.1", test_db)
+    assert checkpoint.config_dict == {"seed": 2 ** 70}
+
+
 def test_get_checkpoint(client):
     """Test getting a specific checkpoint"""
     client.post("/checkpoints", json={
@@ -123,8 +170,7 @@ def test_delete_checkpoint(client):
     assert response.status_code == 404
 
 
-@patch('server.ghost_engine.generate_response')
-def test_chat_endpoint(mock_generate, client):
+def test_chat_endpoint(client, ghost_engine):
     """Test the chat endpoint"""
     # Setup
     client.post("/checkpoints", json={
@@ -136,10 +182,14 @@ def test_chat_endpoint(mock_generate, client):
     client.post("/checkpoints/0.1/activate")
     
     # Mock response
-    mock_generate.return_value = {
+    ghost_engine.generate_response = Mock(return_value={
         "response": "Test response",
-        "sources": []
-    }
+        "sources": [],
+        "pending_messages": [
+            {"checkpoint_version": "0.1", "role": "user", "content": "Hello"},
+            {"checkpoint_version": "0.1", "role": "assistant", "content": "Test response"},
+        ]
+    })
     
     response = client.post("/chat", json={
         "message": "Hello",
@@ -150,6 +200,36 @@ def test_chat_endpoint(mock_generate, client):
     data = response.json()
     assert data["response"] == "Test response"
     assert data["checkpoint_version"] == "0.1"
+    assert ghost_engine.generate_response.call_args.kwargs["persist"] is False
+    
+    # The exchange is written by a background task after the response
+    history = client.get("/history/0.1").json()
+    assert [msg["content"] for msg in history] == ["Hello", "Test response"]
+
+
+def test_chat_stream_endpoint(client, ghost_engine):
+    """Test that the stream endpoint sends tokens as Server-Sent Events"""
+    client.post("/checkpoints", json={
+        "version": "0.1",
+        "description": "Test",
+        "config": {},
+        "metadata": {}
+    })
+    
+    ghost_engine.generate_response_stream = Mock(return_value=iter(["Test", " response"]))
+    
+    response = client.post("/chat/stream", json={
+        "message": "Hello",
+        "checkpoint_version": "0.1"
+    })
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == (
+        'data: {"token":"Test"}\n\n'
+        'data: {"token":" response"}\n\n'
+        'data: [DONE]\n\n'
+    )
 
 
 def test_chat_without_active_checkpoint(client):
@@ -176,3 +256,40 @@ def test_get_stats(client):
     data = response.json()
     assert "checkpoint_version" in data
     assert "total_messages" in data
+
+
+def test_get_stats_counts_messages(client, test_db):
+    """Test that stats count only the checkpoint's messages"""
+    test_db.add_all([
+        Message(checkpoint_version="0.1", role="user", content="Hi"),
+        Message(checkpoint_version="0.1", role="assistant", content="Hello"),
+        Message(checkpoint_version="0.2", role="user", content="Other"),
+    ])
+    test_db.commit()
+    
+    response = client.get("/stats/0.1")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_messages"] == 2
+    assert data["conversation_count"] == 1
+
+
+def test_get_history(client, test_db):
+    """Test that history returns the latest messages oldest first"""
+    test_db.add_all([
+        Message(
+            checkpoint_version="0.1",
+            role="user" if i % 2 == 0 else "assistant",
+            content=f"Message {i}",
+            timestamp=datetime(2024, 1, 1, 0, 0, i)
+        )
+        for i in range(4)
+    ])
+    test_db.commit()
+    
+    response = client.get("/history/0.1", params={"limit": 2})
+    assert response.status_code == 200
+    assert response.json() == [
+        {"role": "user", "content": "Message 2", "timestamp": "2024-01-01T00:00:02"},
+        {"role": "assistant", "content": "Message 3", "timestamp": "2024-01-01T00:00:03"},
+    ]
@@ -1,32 +1,14 @@
 import pytest
-import tempfile
-import os
+from datetime import datetime
 from pathlib import Path
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+from sqlalchemy.exc import IntegrityError
 from checkpoint import CheckpointManager
-from models import Base, Checkpoint
+from models import Checkpoint, Message
 
 
 @pytest.fixture
-def test_db():
-    """Create a temporary test database"""
-    temp_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
-    temp_db.close()
-    
-    db_url = f"sqlite:///{temp_db.name}"
-    engine = create_engine(db_url)
-    Base.metadata.create_all(engine)
-    
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    
-    yield SessionLocal()
-    
-    os.unlink(temp_db.name)
-
-
-@pytest.fixture
-def manager():
+def manager(chroma_path):
     """Create a CheckpointManager instance"""
     return CheckpointManager()
 
@@ -80,6 +62,24 @@ def test_get_nonexistent_checkpoint(manager, test_db):
         manager.get_checkpoint(version="0.999", db=test_db)
 
 
+def test_get_checkpoint_leaves_caller_object_attached(manager, test_db):
+    """Test that edits to a checkpoint after a cached lookup are still committed"""
+    cp = manager.create_checkpoint(version="0.1", description="d", db=test_db)
+    manager.get_checkpoint(version="0.1", db=test_db)
+    
+    cp.description = "changed"
+    test_db.commit()
+    test_db.expire_all()
+    
+    stored = test_db.query(Checkpoint).filter_by(version="0.1").one()
+    assert stored.description == "changed"
+    
+    # Cache hits are copies; editing one never reaches later callers
+    cached = manager.get_checkpoint(version="0.1", db=test_db)
+    cached.description = "edited copy"
+    assert manager.get_checkpoint(version="0.1", db=test_db).description != "edited copy"
+
+
 def test_set_active_checkpoint(manager, test_db):
     """Test setting a checkpoint as active"""
     manager.create_checkpoint(version="0.1", description="First", db=test_db)
@@ -114,3 +114,136 @@ def test_get_active_checkpoint_none(manager, test_db):
     
     active = manager.get_active_checkpoint(db=test_db)
     assert active is None
+
+
+def test_active_checkpoint_cache_invalidated(manager, test_db):
+    """Test that activating a checkpoint refreshes the cached active checkpoint"""
+    manager.create_checkpoint(version="0.1", description="Test", db=test_db)
+    
+    assert manager.get_active_checkpoint(db=test_db) is None
+    
+    manager.set_active_checkpoint(version="0.1", db=test_db)
+    
+    active = manager.get_active_checkpoint(db=test_db)
+    assert active.version == "0.1"
+
+
+def test_active_checkpoint_not_cached_across_concurrent_activate(manager, test_db):
+    """Test that a lookup racing with an activation is not cached"""
+    manager.create_checkpoint(version="0.1", description="First", db=test_db)
+    manager.create_checkpoint(version="0.2", description="Second", db=test_db)
+    manager.set_active_checkpoint(version="0.1", db=test_db)
+    
+    # The racing write shares this session; keep the row read before it
+    # loaded, as it would be in the reading request's own session
+    test_db.expire_on_commit = False
+    execute = test_db.execute
+    activated = []
+    
+    def read_then_activate(*args, **kwargs):
+        if activated:
+            return execute(*args, **kwargs)
+        activated.append(True)
+        result = execute(*args, **kwargs).freeze()
+        # Another request activates a different checkpoint after the read
+        manager.set_active_checkpoint(version="0.2", db=test_db)
+        return result()
+    
+    with patch.object(test_db, "execute", side_effect=read_then_activate):
+        assert manager.get_active_checkpoint(db=test_db).version == "0.1"
+    
+    assert manager.get_active_checkpoint(db=test_db).version == "0.2"
+
+
+def test_set_active_nonexistent_keeps_current(manager, test_db):
+    """Test that activating a missing checkpoint leaves the active one unchanged"""
+    manager.create_checkpoint(version="0.1", description="Test", db=test_db)
+    manager.set_active_checkpoint(version="0.1", db=test_db)
+    
+    with pytest.raises(ValueError, match="not found"):
+        manager.set_active_checkpoint(version="0.999", db=test_db)
+    
+    active = manager.get_active_checkpoint(db=test_db)
+    assert active.version == "0.1"
+
+
+def test_only_one_active_checkpoint_allowed(test_db):
+    """Test that the database rejects a second active checkpoint"""
+    test_db.add(Checkpoint(version="0.1", description="First", is_active=True))
+    test_db.add(Checkpoint(version="0.2", description="Second", is_active=True))
+    
+    with pytest.raises(IntegrityError):
+        test_db.commit()
+
+
+def test_config_dict(manager, test_db):
+    """Test that config_dict parses the stored config once per distinct value"""
+    cp = manager.create_checkpoint(
+        version="0.1",
+        description="Test",
+        config={"personality_note": "Dry humor"},
+        db=test_db
+    )
+    
+    assert cp.config_dict == {"personality_note": "Dry humor"}
+    assert cp.config_dict is cp.config_dict
+    
+    cp.config = None
+    assert cp.config_dict == {}
+
+
+def test_update_checkpoint_config_non_str_keys(manager, test_db):
+    """Test that configs orjson rejects are still serialized like json.dumps"""
+    manager.create_checkpoint(version="0.1", description="Test", db=test_db)
+    
+    manager.update_checkpoint_config(version="0.1", config={1: "one", "big": -2 ** 80}, db=test_db)
+    
+    checkpoint = manager.get_checkpoint(version="0.1", db=test_db)
+    assert checkpoint.config_dict == {"1": "one", "big": -2 ** 80}
+
+
+def test_get_active_checkpoint_cached(manager, test_db):
+    """Test that the active checkpoint is returned with its parsed config"""
+    assert manager.get_active_checkpoint_cached(test_db) == (None, {})
+    
+    manager.create_checkpoint(
+        version="0.1",
+        description="Test",
+        config={"personality_note": "Dry humor"},
+        db=test_db
+    )
+    manager.set_active_checkpoint("0.1", test_db)
+    
+    checkpoint, config = manager.get_active_checkpoint_cached(test_db)
+    
+    assert checkpoint.version == "0.1"
+    assert config == {"personality_note": "Dry humor"}
+
+
+def test_get_checkpoint_with_context(manager, test_db):
+    """Test fetching a checkpoint together with its recent history"""
+    manager.create_checkpoint(version="0.1", description="Test", db=test_db)
+    
+    checkpoint, history = manager.get_checkpoint_with_context("0.1", test_db)
+    assert checkpoint.version == "0.1"
+    assert history == []
+    
+    for i in range(3):
+        test_db.add(Message(
+            checkpoint_version="0.1",
+            role="user",
+            content=f"Message {i}",
+            timestamp=datetime(2024, 1, 1, 0, 0, i)
+        ))
+    test_db.commit()
+    
+    checkpoint, history = manager.get_checkpoint_with_context("0.1", test_db, history_limit=2)
+    assert checkpoint.version == "0.1"
+    assert [msg["content"] for msg in history] == ["Message 1", "Message 2"]
+    
+    checkpoint, history = manager.get_checkpoint_with_context("0.1", test_db, history_limit=0)
+    assert checkpoint.version == "0.1"
+    assert history == []
+    
+    with pytest.raises(ValueError):
+        manager.get_checkpoint_with_context("0.999", test_db)
@@ -0,0 +1,69 @@
+import importlib.util
+import pytest
+from sqlalchemy import create_engine, inspect, text
+import database
+from database import init_db
+from models import Base
+
+
+@pytest.fixture
+def old_engine(tmp_path, monkeypatch):
+    """File database with the tables of an install that predates the newer indexes"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX uq_one_active_checkpoint"))
+        conn.execute(text("DROP INDEX ix_msg_cp_ts"))
+    monkeypatch.setattr(database, "engine", engine)
+    yield engine
+    engine.dispose()
+
+
+def _index_names(engine, table):
+    """Names of the indexes on a table"""
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_init_db_adds_missing_indexes(old_engine):
+    """Test that init_db upgrades an existing database with the indexes it lacks"""
+    assert "uq_one_active_checkpoint" not in _index_names(old_engine, "checkpoints")
+    
+    init_db()
+    
+    assert "uq_one_active_checkpoint" in _index_names(old_engine, "checkpoints")
+    assert "ix_msg_cp_ts" in _index_names(old_engine, "messages")
+
+
+def test_init_db_reports_duplicate_active_checkpoints(old_engine):
+    """Test that an existing database with two active checkpoints fails with a clear error"""
+    with old_engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO checkpoints (version, description, is_active) "
+            "VALUES ('0.1', 'First', 1), ('0.2', 'Second', 1)"
+        ))
+    
+    with pytest.raises(RuntimeError, match="uq_one_active_checkpoint"):
+        init_db()
+
+
+@pytest.fixture
+def file_database(tmp_path, monkeypatch):
+    """A separate copy of the database module configured for a temporary SQLite file"""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'ghost.db'}")
+    spec = importlib.util.spec_from_file_location("database_under_test", database.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    module.engine.dispose()
+
+
+def test_sqlite_pragmas_applied_to_pooled_connections(file_database):
+    """Test that connections checked out of the pool have the WAL and sync pragmas set"""
+    for _ in range(2):
+        # The second checkout reuses the pooled connection from the first
+        with file_database.engine.connect() as conn:
+            assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            # 1 is NORMAL
+            assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    
+    assert file_database.engine.pool.checkedin() == 1
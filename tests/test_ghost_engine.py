@@ -0,0 +1,235 @@
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import Mock, patch
+from sqlalchemy.orm import sessionmaker
+from ghost_engine import GhostEngine
+from models import Message
+
+
+@pytest.fixture
+def engine():
+    """Create a GhostEngine with a mocked vector store"""
+    with patch('ghost_engine.VectorStore'):
+        engine = GhostEngine()
+    
+    engine.vector_store.query.return_value = {
+        "documents": ["Some context"],
+        "metadatas": [{}],
+        "distances": [0.1]
+    }
+    return engine
+
+
+@pytest.fixture
+def mock_openai():
+    """Mock OpenAI chat completion responses"""
+    with patch('ghost_engine.client') as mock_client:
+        mock_response = Mock()
+        mock_response.choices = [Mock(message=Mock(content="Ghost reply"))]
+        mock_client.chat.completions.create.return_value = mock_response
+        yield mock_client
+
+
+def test_get_context_cached(engine):
+    """Test that repeated messages reuse retrieved context"""
+    first = engine.get_context("0.1", "What do you think?")
+    second = engine.get_context("0.1", "What do you think?")
+    
+    assert first == second
+    assert engine.vector_store.query.call_count == 1
+
+
+def test_invalidate_context(engine):
+    """Test that invalidating a checkpoint drops its cached context"""
+    engine.get_context("0.1", "What do you think?")
+    engine.get_context("0.2", "What do you think?")
+    
+    engine.invalidate_context("0.1")
+    engine.get_context("0.1", "What do you think?")
+    engine.get_context("0.2", "What do you think?")
+    
+    assert engine.vector_store.query.call_count == 3
+
+
+def test_get_conversation_history(engine, test_db):
+    """Test that history returns the most recent messages in chronological order"""
+    for i in range(5):
+        test_db.add(Message(
+            checkpoint_version="0.1",
+            role="user" if i % 2 == 0 else "assistant",
+            content=f"Message {i}",
+            timestamp=datetime(2024, 1, 1, 0, 0, i)
+        ))
+    test_db.add(Message(checkpoint_version="0.2", role="user", content="Other"))
+    test_db.commit()
+    
+    history = engine.get_conversation_history(test_db, "0.1", limit=3)
+    
+    assert history == [
+        {"role": "user", "content": "Message 2"},
+        {"role": "assistant", "content": "Message 3"},
+        {"role": "user", "content": "Message 4"},
+    ]
+
+
+def test_generate_response_skips_context_for_trivial_message(engine, test_db, mock_openai):
+    """Test that greetings don't trigger a vector store query"""
+    result = engine.generate_response("Hello", "0.1", test_db)
+    
+    assert result["response"] == "Ghost reply"
+    assert result["sources"] == []
+    engine.vector_store.query.assert_not_called()
+    
+    history = engine.get_conversation_history(test_db, "0.1")
+    assert [msg["role"] for msg in history] == ["user", "assistant"]
+    assert history[1]["content"] == "Ghost reply"
+
+
+def test_generate_response_uses_context(engine, test_db, mock_openai):
+    """Test that regular messages are answered with retrieved context"""
+    result = engine.generate_response("What did you think of the trip?", "0.1", test_db)
+    
+    assert result["sources"][0]["content"] == "Some context"
+    engine.vector_store.query.assert_called_once()
+
+
+def test_generate_response_stream(engine, test_db, mock_openai):
+    """Test that streamed tokens are yielded and the exchange is stored afterwards"""
+    mock_openai.chat.completions.create.return_value = iter([
+        Mock(choices=[Mock(delta=Mock(content="Ghost"))]),
+        Mock(choices=[Mock(delta=Mock(content=None))]),
+        Mock(choices=[Mock(delta=Mock(content=" reply"))]),
+        Mock(choices=[]),
+    ])
+    
+    tokens = engine.generate_response_stream(
+        "Hello",
+        "0.1",
+        test_db,
+        session_factory=sessionmaker(bind=test_db.get_bind())
+    )
+    
+    assert list(tokens) == ["Ghost", " reply"]
+    assert mock_openai.chat.completions.create.call_args.kwargs["stream"] is True
+    
+    history = engine.get_conversation_history(test_db, "0.1")
+    assert history == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Ghost reply"},
+    ]
+
+
+def test_generate_response_uses_given_history(engine, test_db, mock_openai):
+    """Test that passed-in history is used instead of reading it from the database"""
+    test_db.add(Message(checkpoint_version="0.1", role="user", content="Stored"))
+    test_db.commit()
+    
+    engine.generate_response(
+        "Hello",
+        "0.1",
+        test_db,
+        history=[{"role": "user", "content": "Prefetched"}]
+    )
+    
+    messages = mock_openai.chat.completions.create.call_args.kwargs["messages"]
+    assert [msg["content"] for msg in messages[1:]] == ["Prefetched", "Hello"]
+
+
+def test_generate_response_without_persist(engine, test_db, mock_openai):
+    """Test that persist=False returns the exchange instead of writing it"""
+    result = engine.generate_response("Hello", "0.1", test_db, persist=False)
+    
+    assert engine.get_conversation_history(test_db, "0.1") == []
+    assert [row["role"] for row in result["pending_messages"]] == ["user", "assistant"]
+    
+    engine.persist_messages(
+        result["pending_messages"],
+        session_factory=sessionmaker(bind=test_db.get_bind())
+    )
+    history = engine.get_conversation_history(test_db, "0.1")
+    assert [msg["content"] for msg in history] == ["Hello", "Ghost reply"]
+
+
+def test_regenerate_temperature_override(engine, test_db, mock_openai):
+    """Test that a temperature override applies to the regenerated reply only"""
+    engine.temperature = 0.8
+    engine.generate_response("Hello", "0.1", test_db)
+    
+    engine.regenerate_response("0.1", test_db, temperature_override=1.5)
+    assert mock_openai.chat.completions.create.call_args.kwargs["temperature"] == 1.5
+    assert engine.temperature == 0.8
+    
+    engine.generate_response("Hello again", "0.1", test_db)
+    assert mock_openai.chat.completions.create.call_args.kwargs["temperature"] == 0.8
+
+
+def test_get_message_count_cached(engine, test_db, mock_openai):
+    """Test that the message count is cached and recounted after the engine's writes"""
+    test_db.add(Message(checkpoint_version="0.1", role="user", content="Stored"))
+    test_db.commit()
+    
+    assert engine.get_message_count(test_db, "0.1") == 1
+    
+    engine.generate_response("Hello", "0.1", test_db)
+    engine.regenerate_response("0.1", test_db)
+    
+    assert engine.get_message_count(test_db, "0.1") == 4
+    with patch.object(test_db, "scalar") as mock_scalar:
+        assert engine.get_message_count(test_db, "0.1") == 4
+        mock_scalar.assert_not_called()
+
+
+def test_message_count_not_cached_across_concurrent_write(engine, test_db):
+    """Test that a count racing with a persist is not cached"""
+    engine.session_factory = sessionmaker(bind=test_db.get_bind())
+    count_messages = test_db.scalar
+    
+    def count_then_persist(*args, **kwargs):
+        count = count_messages(*args, **kwargs)
+        # Another request stores an exchange after the count was taken
+        engine.persist_messages(engine._exchange_rows("0.1", "Hello", "Hi there"))
+        return count
+    
+    with patch.object(test_db, "scalar", side_effect=count_then_persist):
+        assert engine.get_message_count(test_db, "0.1") == 0
+    
+    assert engine.get_message_count(test_db, "0.1") == 2
+
+
+def test_message_count_reads_do_not_track_generations(engine, test_db):
+    """Test that counting unknown checkpoints doesn't grow the write-generation map"""
+    for i in range(10):
+        engine.get_message_count(test_db, f"missing-{i}")
+    
+    assert engine._count_generations == {}
+
+
+def test_context_lookups_run_concurrently(engine, mock_openai):
+    """Test that more than four chats can have a context lookup in flight at once"""
+    in_flight = 8
+    barrier = threading.Barrier(in_flight, timeout=5)
+    
+    def slow_query(checkpoint_version, query_text, n_results):
+        # Only returns once every lookup has started
+        barrier.wait()
+        return {"documents": [query_text], "metadatas": [{}], "distances": [0.1]}
+    
+    engine.vector_store.query.side_effect = slow_query
+    
+    def chat(i):
+        return engine.generate_response(
+            f"Tell me about topic {i}",
+            "0.1",
+            db=None,
+            history=[],
+            persist=False
+        )
+    
+    with ThreadPoolExecutor(max_workers=in_flight) as requests:
+        results = list(requests.map(chat, range(in_flight)))
+    
+    assert [r["sources"][0]["content"] for r in results] == [
+        f"Tell me about topic {i}" for i in range(in_flight)
+    ]
@@ -1,11 +1,16 @@
 import pytest
 import tempfile
 from pathlib import Path
+from unittest.mock import Mock
+from sqlalchemy import select, func
+import database
+import ingest
 from ingest import DataIngester
+from models import SourceDocument
 
 
 @pytest.fixture
-def ingester():
+def ingester(chroma_path):
     """Create a DataIngester instance"""
     return DataIngester()
 
@@ -81,3 +86,119 @@ def test_chunk_text_custom_sizes(ingester):
     chunks_large = ingester.chunk_text(text, chunk_size=500, overlap=50)
     
     assert len(chunks_small) > len(chunks_large)
+
+
+def test_prepare_text_file_streams_same_chunks(ingester, sample_text_file, monkeypatch):
+    """Test that streaming a file in small blocks yields the same chunks as chunking it in memory"""
+    expected = ingester.chunk_text(sample_text_file.read_text())
+    monkeypatch.setattr(ingest, "READ_BLOCK_SIZE", 64)
+    
+    documents, metadatas, ids, rows = ingester.prepare_text_file(sample_text_file, "text")
+    
+    assert documents == expected
+    assert len(ids) == len(rows) == len(documents)
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    """Create a directory tree with files that share a stem"""
+    root = tmp_path / "source"
+    (root / "a").mkdir(parents=True)
+    (root / "b").mkdir()
+    (root / "a" / "notes.txt").write_text("Notes from a. " * 10)
+    (root / "b" / "notes.txt").write_text("Notes from b. " * 10)
+    (root / "notes.md").write_text("Top-level notes. " * 10)
+    (root / "image.png").write_bytes(b"not text")
+    return root
+
+
+def test_iter_files(source_tree):
+    """Test that files are found recursively and filtered by extension"""
+    paths = sorted(
+        Path(path).relative_to(source_tree).as_posix()
+        for path in ingest._iter_files(str(source_tree), {".txt"})
+    )
+    
+    assert paths == ["a/notes.txt", "b/notes.txt"]
+
+
+def test_ingest_directory_same_stem_ids(ingester, source_tree, test_db, monkeypatch):
+    """Test that files sharing a stem get distinct ids and are all stored"""
+    ingester.vector_store = Mock()
+    monkeypatch.setattr(database, "SessionLocal", lambda: test_db)
+    
+    ids = ingester.ingest_directory(source_tree, "text", "0.1", extensions=[".txt", ".md"])
+    
+    assert len(ids) == len(set(ids)) == 3
+    assert set(ids) == {"a/notes.txt_0", "b/notes.txt_0", "notes.md_0"}
+    sent_ids = [
+        doc_id
+        for call in ingester.vector_store.add_documents.call_args_list
+        for doc_id in call.kwargs["ids"]
+    ]
+    assert sorted(sent_ids) == sorted(ids)
+    assert test_db.scalar(select(func.count()).select_from(SourceDocument)) == 3
+
+
+def test_ingest_directory_batches_across_files(ingester, source_tree, test_db, monkeypatch):
+    """Test that batches are sent and committed as they fill, across files"""
+    ingester.vector_store = Mock()
+    monkeypatch.setattr(database, "SessionLocal", lambda: test_db)
+    monkeypatch.setattr(ingest, "BATCH_SIZE", 2)
+    
+    ids = ingester.ingest_directory(source_tree, "text", "0.1", extensions=[".txt", ".md"])
+    
+    # Three one-chunk files: one batch of two, then the remainder
+    assert [len(call.kwargs["ids"]) for call in ingester.vector_store.add_documents.call_args_list] == [2, 1]
+    assert test_db.scalar(select(func.count()).select_from(SourceDocument)) == len(ids) == 3
+
+
+def test_ingest_file_and_directory_share_ids(ingester, source_tree, test_db, monkeypatch):
+    """Test that ingesting a file alone and then with its directory stores it once"""
+    ingester.vector_store = Mock()
+    monkeypatch.setattr(database, "SessionLocal", lambda: test_db)
+    
+    file_ids = ingester.ingest_text_file(source_tree / "notes.md", "text", "0.1", test_db)
+    nested_ids = ingester.ingest_text_file(source_tree / "a" / "notes.txt", "text", "0.1", test_db, root=source_tree)
+    dir_ids = ingester.ingest_directory(source_tree, "text", "0.1", extensions=[".txt", ".md"])
+    
+    assert file_ids == ["notes.md_0"]
+    assert nested_ids == ["a/notes.txt_0"]
+    assert set(file_ids + nested_ids) <= set(dir_ids)
+    stored = test_db.scalars(select(SourceDocument.embedding_id)).all()
+    assert sorted(stored) == sorted(dir_ids)
+
+
+def test_ingest_directory_splits_large_file(ingester, tmp_path, test_db, monkeypatch):
+    """Test that a file longer than BATCH_SIZE chunks is committed in bounded batches"""
+    (tmp_path / "long.txt").write_text("A long sentence for the chunker. " * 500)
+    ingester.vector_store = Mock()
+    monkeypatch.setattr(database, "SessionLocal", lambda: test_db)
+    monkeypatch.setattr(ingest, "BATCH_SIZE", 3)
+    
+    committed = []
+    write_rows = ingester._write_rows
+    
+    def record_write(rows, db=None):
+        committed.append(len(rows))
+        write_rows(rows, db)
+    
+    monkeypatch.setattr(ingester, "_write_rows", record_write)
+    
+    ids = ingester.ingest_directory(tmp_path, "text", "0.1", extensions=[".txt"])
+    
+    assert len(ids) > 3
+    assert len(committed) > 1
+    assert max(committed) <= 3
+    assert sum(committed) == len(ids) == len(set(ids))
+    assert test_db.scalar(select(func.count()).select_from(SourceDocument)) == len(ids)
+
+
+def test_write_rows_rolls_back_on_error(ingester, test_db):
+    """Test that a failed write is rolled back and leaves the session usable"""
+    ingester._write_rows([SourceDocument(id=1, source_type="text", content="first")], test_db)
+    
+    with pytest.raises(Exception):
+        ingester._write_rows([SourceDocument(id=1, source_type="text", content="duplicate")], test_db)
+    
+    assert test_db.scalar(select(func.count()).select_from(SourceDocument)) == 1
@@ -1,9 +1,18 @@
 import pytest
+import base64
 import tempfile
 import shutil
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from unittest.mock import Mock, patch
-from vector_store import VectorStore
+from cachetools import TTLCache
+from vector_store import COLLECTION_CACHE_TTL_SECONDS, QueryBatcher, VectorStore
+
+# What the API returns for encoding_format="base64"
+EMBEDDING_B64 = base64.b64encode(np.full(1536, 0.1, dtype=np.float32).tobytes()).decode()
 
 
 @pytest.fixture
@@ -17,10 +26,12 @@ def temp_db_path():
 @pytest.fixture
 def mock_openai():
     """Mock OpenAI embedding responses"""
+    def create_embeddings(model, input, encoding_format, dimensions=None):
+        texts = input if isinstance(input, list) else [input]
+        return Mock(data=[Mock(embedding=EMBEDDING_B64) for _ in texts])
+    
     with patch('vector_store.client') as mock_client:
-        mock_response = Mock()
-        mock_response.data = [Mock(embedding=[0.1] * 1536)]
-        mock_client.embeddings.create.return_value = mock_response
+        mock_client.embeddings.create.side_effect = create_embeddings
         yield mock_client
 
 
@@ -49,7 +60,20 @@ def test_add_documents(temp_db_path, mock_openai):
     )
     
     assert len(ids) == 2
-    assert mock_openai.embeddings.create.call_count == 2
+    # Both documents are embedded in one request
+    assert mock_openai.embeddings.create.call_count == 1
+
+
+def test_add_documents_replaces_same_ids(temp_db_path, mock_openai):
+    """Test that re-adding a document id replaces it instead of duplicating it"""
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    store.add_documents(checkpoint_version="0.1", documents=["old text"], ids=["notes.md_0"])
+    store.add_documents(checkpoint_version="0.1", documents=["new text"], ids=["notes.md_0"])
+    
+    collection = store.get_or_create_collection("0.1")
+    assert collection.count() == 1
+    assert collection.get(ids=["notes.md_0"])["documents"] == ["new text"]
 
 
 def test_query_documents(temp_db_path, mock_openai):
@@ -104,3 +128,244 @@ def test_list_collections(temp_db_path, mock_openai):
     assert len(collections) >= 2
     assert any("0_1" in c for c in collections)
     assert any("0_2" in c for c in collections)
+
+
+def test_get_embeddings_batches_requests(temp_db_path, mock_openai):
+    """Test that embeddings are requested in batches"""
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    embeddings = store.get_embeddings([f"text {i}" for i in range(5)], batch_size=2)
+    
+    assert len(embeddings) == 5
+    assert mock_openai.embeddings.create.call_count == 3
+
+
+def test_get_embeddings_batches_in_flight_concurrently(temp_db_path, mock_openai):
+    """Test that several embedding batches are requested at once, with results in input order"""
+    in_flight = 4
+    barrier = threading.Barrier(in_flight, timeout=5)
+    
+    def slow_create(model, input, encoding_format, dimensions=None):
+        # Only returns once every batch request has started
+        barrier.wait()
+        value = float(input[0].split()[-1])
+        embedding = base64.b64encode(np.full(8, value, dtype=np.float32).tobytes()).decode()
+        return Mock(data=[Mock(embedding=embedding) for _ in input])
+    
+    mock_openai.embeddings.create.side_effect = slow_create
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    array = store.get_embedding_array([f"text {i}" for i in range(in_flight)], batch_size=1)
+    
+    assert mock_openai.embeddings.create.call_count == in_flight
+    assert array[:, 0].tolist() == [float(i) for i in range(in_flight)]
+
+
+def test_get_embeddings_cached(temp_db_path, mock_openai):
+    """Test that repeated texts are embedded only once"""
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    store.get_embedding("Repeated query")
+    embeddings = store.get_embeddings(["Repeated query", "New text", "New text"])
+    
+    assert len(embeddings) == 3
+    assert mock_openai.embeddings.create.call_count == 2
+    assert mock_openai.embeddings.create.call_args.kwargs["input"] == ["New text"]
+
+
+def test_get_embeddings_cache_disabled(temp_db_path, mock_openai):
+    """Test that cache=False always calls the API"""
+    store = VectorStore(persist_directory=temp_db_path, cache=False, disk_cache=False)
+    
+    store.get_embedding("Repeated query")
+    store.get_embedding("Repeated query")
+    
+    assert mock_openai.embeddings.create.call_count == 2
+
+
+def test_get_embeddings_disk_cache(temp_db_path, mock_openai):
+    """Test that embeddings survive a restart via the on-disk cache"""
+    VectorStore(persist_directory=temp_db_path).get_embeddings(["Chunk one", "Chunk two"])
+    
+    store = VectorStore(persist_directory=temp_db_path)
+    embeddings = store.get_embeddings(["Chunk one", "Chunk two", "Chunk three"])
+    
+    assert len(embeddings) == 3
+    assert embeddings[0] == pytest.approx([0.1] * 1536, abs=1e-3)
+    assert mock_openai.embeddings.create.call_count == 2
+    assert mock_openai.embeddings.create.call_args.kwargs["input"] == ["Chunk three"]
+
+
+def test_concurrent_queries_share_embedding_request(temp_db_path, mock_openai):
+    """Test that queries missing the cache while another is in flight share one request"""
+    store = VectorStore(persist_directory=temp_db_path, query_batch_wait=5)
+    store._query_batcher.max_batch = 3
+    create = mock_openai.embeddings.create.side_effect
+    first_sent = threading.Event()
+    second_sent = threading.Event()
+    
+    def gated_create(**kwargs):
+        if not first_sent.is_set():
+            # Hold the first request open until the queued queries are sent
+            first_sent.set()
+            second_sent.wait(5)
+        else:
+            second_sent.set()
+        return create(**kwargs)
+    
+    mock_openai.embeddings.create.side_effect = gated_create
+    
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        first = pool.submit(store._embed_query, "Question 0")
+        first_sent.wait(5)
+        rest = [pool.submit(store._embed_query, f"Question {i}") for i in range(1, 4)]
+        arrays = [future.result() for future in [first] + rest]
+    
+    assert [array.shape for array in arrays] == [(1, 1536)] * 4
+    assert mock_openai.embeddings.create.call_count == 2
+    assert sorted(mock_openai.embeddings.create.call_args.kwargs["input"]) == [
+        f"Question {i}" for i in range(1, 4)
+    ]
+    
+    # Cached queries skip the batcher
+    store._embed_query("Question 0")
+    assert mock_openai.embeddings.create.call_count == 2
+
+
+def test_query_batcher_sends_idle_query_at_once():
+    """Test that a query with no other traffic does not wait for a batch to form"""
+    batcher = QueryBatcher(lambda texts: np.zeros((len(texts), 4), dtype=np.float32), max_wait=5)
+    
+    start = time.monotonic()
+    assert batcher.embed("Only question").shape == (1, 4)
+    assert time.monotonic() - start < 1
+
+
+def test_query_batcher_caps_batch_size():
+    """Test that no request carries more than max_batch texts however many callers queue"""
+    sizes = []
+    
+    def embed(texts):
+        sizes.append(len(texts))
+        time.sleep(0.01)
+        return np.zeros((len(texts), 4), dtype=np.float32)
+    
+    batcher = QueryBatcher(embed, max_batch=8, max_wait=0.05)
+    barrier = threading.Barrier(64, timeout=5)
+    
+    def run(i):
+        barrier.wait()
+        return batcher.embed(f"Question {i}")
+    
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        arrays = list(pool.map(run, range(64)))
+    
+    assert [array.shape for array in arrays] == [(1, 4)] * 64
+    assert max(sizes) <= 8
+    assert sum(sizes) == 64
+
+
+def test_query_batcher_propagates_errors():
+    """Test that a failed batch raises in every waiting caller"""
+    batcher = QueryBatcher(Mock(side_effect=RuntimeError("API down")), max_batch=2, max_wait=0.05)
+    
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(batcher.embed, text) for text in ("a", "b")]
+    
+    for future in futures:
+        with pytest.raises(RuntimeError, match="API down"):
+            future.result()
+
+
+def test_get_embedding_array(temp_db_path, mock_openai):
+    """Test that embeddings are decoded into one float32 array"""
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    array = store.get_embedding_array(["First", "Second", "First"])
+    
+    assert array.shape == (3, 1536)
+    assert array.dtype == np.float32
+    assert np.allclose(array, 0.1)
+    assert mock_openai.embeddings.create.call_args.kwargs["encoding_format"] == "base64"
+
+
+def test_collection_handle_cached(temp_db_path):
+    """Test that collection handles are reused until the collection is deleted"""
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    first = store.get_or_create_collection("0.1")
+    assert store.get_or_create_collection("0.1") is first
+    
+    store.delete_collection("0.1")
+    assert store.get_or_create_collection("0.1") is not first
+
+
+def test_collection_handle_refreshed_after_external_delete(temp_db_path, mock_openai):
+    """Test that a collection re-created by another store is picked up once the handle expires"""
+    now = [0.0]
+    store = VectorStore(persist_directory=temp_db_path)
+    store._collections = TTLCache(maxsize=128, ttl=COLLECTION_CACHE_TTL_SECONDS, timer=lambda: now[0])
+    store.add_documents(checkpoint_version="0.1", documents=["old doc"])
+    
+    # Another process (e.g. the checkpoint CLI) deletes and re-ingests the checkpoint
+    other = VectorStore(persist_directory=temp_db_path)
+    other.delete_collection("0.1")
+    other.add_documents(checkpoint_version="0.1", documents=["new doc"])
+    
+    now[0] += COLLECTION_CACHE_TTL_SECONDS + 1
+    results = store.query(checkpoint_version="0.1", query_text="doc", n_results=1)
+    
+    assert results["documents"] == ["new doc"]
+
+
+def test_embedding_dimensions(temp_db_path, mock_openai, monkeypatch):
+    """Test that EMBED_DIM is requested and kept out of other sizes' collections"""
+    monkeypatch.setenv("EMBED_DIM", "256")
+    store = VectorStore(persist_directory=temp_db_path)
+    
+    store.get_embedding("Some text")
+    
+    assert mock_openai.embeddings.create.call_args.kwargs["dimensions"] == 256
+    assert store.get_or_create_collection("0.1").name == "ghost_0_1-d256"
+    
+    monkeypatch.setenv("EMBED_DIM", "0")
+    native = VectorStore(persist_directory=temp_db_path, cache=False)
+    native.get_embedding("Some text")
+    
+    assert "dimensions" not in mock_openai.embeddings.create.call_args.kwargs
+    assert native.get_or_create_collection("0.1").name == "ghost_0_1"
+    # A version ending in the same digits never shares a sized collection
+    assert native.get_or_create_collection("0.1.256").name == "ghost_0_1_256"
+
+
+def test_query_skips_disk_cache(temp_db_path, mock_openai):
+    """Test that query embeddings are cached in memory but never written to disk"""
+    store = VectorStore(persist_directory=temp_db_path)
+    store.add_documents(checkpoint_version="0.1", documents=["Stored chunk"])
+    
+    store.query(checkpoint_version="0.1", query_text="Chat message", n_results=1)
+    store.query(checkpoint_version="0.1", query_text="Chat message", n_results=1)
+    assert mock_openai.embeddings.create.call_count == 2
+    
+    VectorStore(persist_directory=temp_db_path).get_embeddings(["Stored chunk", "Chat message"])
+    assert mock_openai.embeddings.create.call_args.kwargs["input"] == ["Chat message"]
+
+
+def test_delete_collection_all_dimensions(temp_db_path, mock_openai, monkeypatch):
+    """Test that deleting a checkpoint removes its collections at every embedding size"""
+    monkeypatch.setenv("EMBED_DIM", "0")
+    native = VectorStore(persist_directory=temp_db_path)
+    native.get_or_create_collection("0.1")
+    # Shares 0.1's prefix; kept because it belongs to 0.1.5
+    native.get_or_create_collection("0.1.5")
+    monkeypatch.setenv("EMBED_DIM", "256")
+    VectorStore(persist_directory=temp_db_path).get_or_create_collection("0.1")
+    
+    monkeypatch.setenv("EMBED_DIM", "512")
+    store = VectorStore(persist_directory=temp_db_path)
+    store.get_or_create_collection("0.1")
+    store.get_or_create_collection("0.1.5")
+    
+    store.delete_collection("0.1")
+    
+    assert sorted(store.list_collections()) == ["ghost_0_1_5", "ghost_0_1_5-d512"]
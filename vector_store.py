@@ -1,36 +1,339 @@
+import base64
 import chromadb
 from chromadb.config import Settings
 from openai import OpenAI
 import os
-from typing import List, Dict
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import List, Dict, Optional, Tuple
 import json
+import numpy as np
+from cachetools import LRUCache, TTLCache
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Number of texts sent per embeddings request
+EMBEDDING_BATCH_SIZE = 128
+
+# Maximum embeddings requests in flight at once while embedding many batches
+EMBEDDING_CONCURRENCY = 8
+
+# Embeddings kept in memory per VectorStore, keyed by (model/dimensions, text)
+EMBEDDING_CACHE_SIZE = 1024
+
+# Concurrent query() calls that miss the cache share one embeddings request
+# of up to this many texts. While other queries are pending or in flight, the
+# caller collecting a batch waits at most this long for more to join; an idle
+# query is sent at once, so only busy periods trade a little latency for fewer
+# requests. A wait of 0 disables coalescing.
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_WAIT_SECONDS = 0.01
+
+# Default embedding size requested from OpenAI. text-embedding-3 models can
+# shorten their vectors; 512 keeps most retrieval quality at a third of the
+# size. Set EMBED_DIM=0 to use the model's native size (needed for ada-002).
+DEFAULT_EMBED_DIM = 512
+
+# Collection handles are re-resolved after this long, so a collection deleted
+# and re-created by another process (e.g. the checkpoint CLI) is picked up
+COLLECTION_CACHE_TTL_SECONDS = 60
+
+# File (inside the persist directory) holding embeddings across restarts
+EMBEDDING_CACHE_FILE = "embed_cache.sqlite3"
+
+# Keys per SELECT ... IN (...), below SQLite's bound-parameter limit
+_EMBED_CACHE_QUERY_SIZE = 500
+
+
+def _decode_embedding(embedding) -> np.ndarray:
+    """Turn an API embedding (base64 float32, or a list if the API sent floats) into a vector"""
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _embeddings_request(embedding_model: str, texts: List[str], dimensions: int = 0) -> Dict:
+    """Arguments for an embeddings call that returns raw float32 bytes"""
+    request = {"model": embedding_model, "input": texts, "encoding_format": "base64"}
+    if dimensions:
+        request["dimensions"] = dimensions
+    return request
+
+
+class _EmbedCache:
+    """Persistent embedding cache keyed by sha256(model + dimensions + text), stored as float16 blobs"""
+    
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embed_cache_f16 (key BLOB PRIMARY KEY, vec BLOB NOT NULL)"
+            )
+            self._conn.commit()
+    
+    @staticmethod
+    def key(namespace: str, text: str) -> bytes:
+        """Cache key; namespace names the model and dimensions so switching either never collides"""
+        return hashlib.sha256(f"{namespace}\x00{text}".encode()).digest()
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return the cached embeddings for whichever keys are present"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _EMBED_CACHE_QUERY_SIZE):
+                batch = keys[start:start + _EMBED_CACHE_QUERY_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embed_cache_f16 WHERE key IN ({placeholders})",
+                    batch
+                )
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float16)
+        return found
+    
+    def put_many(self, items: Dict[bytes, np.ndarray]):
+        """Store new embeddings in one transaction"""
+        rows = [
+            (key, np.asarray(embedding, dtype=np.float16).tobytes())
+            for key, embedding in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO embed_cache_f16 (key, vec) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+
+class QueryBatcher:
+    """Coalesces query embeddings requested concurrently from several threads into one request
+    
+    One caller at a time collects a batch: if other queries are pending or in
+    flight it waits up to max_wait for more to join (or for max_batch texts),
+    then embeds at most max_batch texts and hands every caller its row. Texts
+    left over stay queued for the next caller to collect.
+    """
+    
+    def __init__(
+        self,
+        embed,
+        max_batch: int = QUERY_BATCH_SIZE,
+        max_wait: float = QUERY_BATCH_WAIT_SECONDS
+    ):
+        self._embed = embed
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._ready = threading.Condition()
+        self._pending = []
+        self._collecting = False
+        self._in_flight = 0
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Add text to the next batch and wait for its (1, dim) embedding"""
+        future = Future()
+        entry = (text, future)
+        with self._ready:
+            self._pending.append(entry)
+            self._ready.notify_all()
+        
+        while True:
+            with self._ready:
+                # Served by another caller, or still queued with no one collecting
+                self._ready.wait_for(
+                    lambda: future.done() or (not self._collecting and entry in self._pending)
+                )
+                if future.done():
+                    break
+                
+                self._collecting = True
+                if self._in_flight or len(self._pending) > 1:
+                    self._ready.wait_for(lambda: len(self._pending) >= self.max_batch, self.max_wait)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self._collecting = False
+                self._in_flight += 1
+                self._ready.notify_all()
+            
+            try:
+                self._send(batch)
+            finally:
+                with self._ready:
+                    self._in_flight -= 1
+                    self._ready.notify_all()
+        return future.result()
+    
+    def _send(self, batch: List[Tuple[str, Future]]):
+        """Embed one batch and resolve each caller's future with its row or the error"""
+        try:
+            rows = self._embed([text for text, _ in batch])
+        except BaseException as e:
+            for _, waiter in batch:
+                waiter.set_exception(e)
+        else:
+            for i, (_, waiter) in enumerate(batch):
+                waiter.set_result(rows[i:i + 1])
+
 
 class VectorStore:
-    def __init__(self, persist_directory: str = None):
+    def __init__(
+        self,
+        persist_directory: str = None,
+        cache: bool = True,
+        cache_size: int = EMBEDDING_CACHE_SIZE,
+        disk_cache: bool = True,
+        query_batch_wait: float = QUERY_BATCH_WAIT_SECONDS
+    ):
         if persist_directory is None:
             persist_directory = os.getenv("CHROMA_PATH", "./chroma_db")
         
         self.chroma_client = chromadb.PersistentClient(path=persist_directory)
         self.embedding_model = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+        self.embedding_dim = int(os.getenv("EMBED_DIM", str(DEFAULT_EMBED_DIM)))
+        self._cache_namespace = f"{self.embedding_model}/{self.embedding_dim}"
+        self._embedding_lock = threading.Lock()
+        self._embedding_cache = LRUCache(maxsize=cache_size) if cache else None
+        self._disk_cache = (
+            _EmbedCache(os.path.join(persist_directory, EMBEDDING_CACHE_FILE))
+            if disk_cache else None
+        )
+        self._query_batcher = (
+            QueryBatcher(partial(self.get_embedding_array, persist=False), max_wait=query_batch_wait)
+            if query_batch_wait > 0 else None
+        )
+        self._collections_lock = threading.Lock()
+        self._collections = TTLCache(maxsize=128, ttl=COLLECTION_CACHE_TTL_SECONDS)
         
     def get_or_create_collection(self, checkpoint_version: str):
-        """Get or create a collection for a specific checkpoint version"""
-        collection_name = f"ghost_{checkpoint_version.replace('.', '_')}"
-        return self.chroma_client.get_or_create_collection(
-            name=collection_name,
+        """Get or create a collection for a specific checkpoint version (handles are cached briefly)"""
+        with self._collections_lock:
+            collection = self._collections.get(checkpoint_version)
+        if collection is not None:
+            return collection
+        
+        collection = self.chroma_client.get_or_create_collection(
+            name=self._collection_name(checkpoint_version),
             metadata={"checkpoint_version": checkpoint_version}
         )
+        with self._collections_lock:
+            self._collections[checkpoint_version] = collection
+        return collection
+    
+    def _collection_name(self, checkpoint_version: str) -> str:
+        """Collection name for a checkpoint; vectors of different sizes never share one"""
+        name = f"ghost_{checkpoint_version.replace('.', '_')}"
+        # Versions map '.' to '_', so the size gets its own "-d" marker
+        return f"{name}-d{self.embedding_dim}" if self.embedding_dim else name
+    
+    def forget_collection(self, checkpoint_version: str):
+        """Drop the cached handle for a checkpoint's collection"""
+        with self._collections_lock:
+            self._collections.pop(checkpoint_version, None)
     
     def get_embedding(self, text: str) -> List[float]:
         """Generate embedding for text using OpenAI"""
+        return self.get_embeddings([text])[0]
+    
+    def _lookup_cached(
+        self,
+        texts: List[str],
+        persist: bool = True
+    ) -> Tuple[List[Optional[np.ndarray]], List[str]]:
+        """Return cached embeddings (None where missing) and the distinct uncached texts
+        
+        With persist=False only the in-memory cache is consulted.
+        """
+        found = [None] * len(texts)
+        if self._embedding_cache is not None:
+            with self._embedding_lock:
+                found = [self._embedding_cache.get((self._cache_namespace, text)) for text in texts]
+        missing = list(dict.fromkeys(text for text, emb in zip(texts, found) if emb is None))
+        
+        # Fall back to the on-disk cache, promoting hits into memory
+        if missing and persist and self._disk_cache is not None:
+            keys = {text: _EmbedCache.key(self._cache_namespace, text) for text in missing}
+            stored = self._disk_cache.get_many(list(keys.values()))
+            if stored:
+                hits = {text: stored[key] for text, key in keys.items() if key in stored}
+                found = [emb if emb is not None else hits.get(text) for text, emb in zip(texts, found)]
+                missing = [text for text in missing if text not in hits]
+                self._remember(hits)
+        
+        return found, missing
+    
+    def _remember(self, embeddings: Dict[str, np.ndarray]):
+        """Put embeddings into the in-memory cache"""
+        if self._embedding_cache is None:
+            return
+        with self._embedding_lock:
+            for text, embedding in embeddings.items():
+                self._embedding_cache[(self._cache_namespace, text)] = embedding
+    
+    def _merge_cached(
+        self,
+        texts: List[str],
+        found: List[Optional[np.ndarray]],
+        missing: List[str],
+        fetched: List[np.ndarray],
+        persist: bool = True
+    ) -> np.ndarray:
+        """Assemble an (n, dim) float32 array from found and fetched embeddings, remembering the fetched ones"""
+        new = dict(zip(missing, fetched))
+        if new:
+            self._remember(new)
+            if persist and self._disk_cache is not None:
+                self._disk_cache.put_many({
+                    _EmbedCache.key(self._cache_namespace, text): embedding
+                    for text, embedding in new.items()
+                })
+        vectors = [emb if emb is not None else new[text] for text, emb in zip(texts, found)]
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        
+        # Rows are copied straight from the decoded buffers; no float lists
+        array = np.empty((len(vectors), len(vectors[0])), dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            array[i] = vector
+        return array
+    
+    def get_embedding_array(
+        self,
+        texts: List[str],
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        persist: bool = True
+    ) -> np.ndarray:
+        """Embed many texts into an (n, dim) float32 array, one OpenAI request per batch of uncached texts
+        
+        persist=False keeps the texts out of the on-disk cache (memory only),
+        for one-off texts such as chat queries.
+        """
+        found, missing = self._lookup_cached(texts, persist)
+        
+        # Batch requests overlap their network latency; map keeps input order
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+        if len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=min(EMBEDDING_CONCURRENCY, len(batches))) as pool:
+                results = list(pool.map(self._embed_batch, batches))
+        else:
+            results = [self._embed_batch(batch) for batch in batches]
+        
+        fetched = [embedding for batch in results for embedding in batch]
+        return self._merge_cached(texts, found, missing, fetched, persist)
+    
+    def _embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """Embed one batch of texts with a single OpenAI request"""
         response = client.embeddings.create(
-            model=self.embedding_model,
-            input=text
+            **_embeddings_request(self.embedding_model, texts, self.embedding_dim)
         )
-        return response.data[0].embedding
+        return [_decode_embedding(item.embedding) for item in response.data]
+    
+    def get_embeddings(
+        self,
+        texts: List[str],
+        batch_size: int = EMBEDDING_BATCH_SIZE
+    ) -> List[List[float]]:
+        """Generate embeddings for many texts, one OpenAI request per batch of uncached texts"""
+        return self.get_embedding_array(texts, batch_size).tolist()
     
     def add_documents(
         self,
@@ -39,20 +342,20 @@ class VectorStore:
         metadatas: List[Dict] = None,
         ids: List[str] = None
     ):
-        """Add documents to the vector store"""
+        """Add documents to the vector store, replacing any with the same ids"""
         collection = self.get_or_create_collection(checkpoint_version)
         
         # Generate embeddings
-        embeddings = [self.get_embedding(doc) for doc in documents]
+        embeddings = self.get_embedding_array(documents)
         
         # Generate IDs if not provided
         if ids is None:
             ids = [f"doc_{i}" for i in range(len(documents))]
         
-        collection.add(
+        collection.upsert(
             documents=documents,
             embeddings=embeddings,
-            metadatas=metadatas or [{} for _ in documents],
+            metadatas=metadatas,
             ids=ids
         )
         
@@ -67,10 +370,9 @@ class VectorStore:
         """Query the vector store for relevant documents"""
         collection = self.get_or_create_collection(checkpoint_version)
         
-        query_embedding = self.get_embedding(query_text)
-        
+        query_embeddings = self._embed_query(query_text)
         results = collection.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_embeddings,
             n_results=n_results
         )
         
@@ -80,13 +382,32 @@ class VectorStore:
             "distances": results["distances"][0] if results["distances"] else []
         }
     
+    def _embed_query(self, query_text: str) -> np.ndarray:
+        """Embed a query as a (1, dim) array, sharing a request with concurrent cache misses"""
+        # Queries are rarely repeated after a restart, so both paths (the
+        # batcher embeds with persist=False too) keep them in memory only
+        if self._query_batcher is not None:
+            _, missing = self._lookup_cached([query_text], persist=False)
+            if missing:
+                return self._query_batcher.embed(query_text)
+        
+        return self.get_embedding_array([query_text], persist=False)
+    
     def delete_collection(self, checkpoint_version: str):
-        """Delete a checkpoint's collection"""
-        collection_name = f"ghost_{checkpoint_version.replace('.', '_')}"
-        try:
-            self.chroma_client.delete_collection(name=collection_name)
-        except:
-            pass
+        """Delete a checkpoint's collections at every embedding size, including pre-EMBED_DIM ones"""
+        self.forget_collection(checkpoint_version)
+        base = f"ghost_{checkpoint_version.replace('.', '_')}"
+        for collection in self.chroma_client.list_collections():
+            name = collection.name
+            if name != base and not (name.startswith(f"{base}-d") and name[len(base) + 2:].isdigit()):
+                continue
+            # Versions may themselves contain "-d", so trust the recorded version
+            if (collection.metadata or {}).get("checkpoint_version", checkpoint_version) != checkpoint_version:
+                continue
+            try:
+                self.chroma_client.delete_collection(name=name)
+            except:
+                pass
     
     def list_collections(self) -> List[str]:
         """List all checkpoint collections"""